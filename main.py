@@ -1,28 +1,56 @@
 import asyncio
+import functools
 import requests
 from fastapi import FastAPI, Query, Request, HTTPException, File, UploadFile, Header, Depends, Form
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 from typing import List, Optional, Annotated
 import secrets
+import tempfile
+import threading
+import contextlib
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
-from email import encoders
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse, FileResponse
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.errors import HttpError
 from dotenv import load_dotenv
 import os
 import json
 import google.oauth2.credentials
+import google.auth.exceptions
+import google.auth.transport.requests
 import traceback
 import base64
+import hashlib
+import mimetypes
+import urllib.parse
+import zipfile
+import shutil
+import re
+import sqlite3
+from collections import OrderedDict
+import time
 import httpx
 import httplib2
+import google_auth_httplib2
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from datetime import datetime
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:  # Windows: niente lock su file tra processi
+    fcntl = None
+
+try:
+    import h2  # noqa: F401 - abilita HTTP/2 in httpx
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -49,10 +77,82 @@ SCOPES = [
 # Percorsi di configurazione
 TOKEN_FILE = os.getenv("TOKEN_FILE", "/var/www/ai/GoogleApp/token.json")
 ATTACHMENT_DIR = os.getenv("ATTACHMENT_DIR", "/var/www/ai/GoogleApp/tmp/")
+# Blob degli allegati per SHA-256; deve stare sullo stesso filesystem di ATTACHMENT_DIR (hardlink)
+ATTACHMENT_STORE_DIR = os.getenv("ATTACHMENT_STORE_DIR", os.path.join(ATTACHMENT_DIR, ".store"))
 GOOGLE_CREDENTIALS = os.getenv("GOOGLE_CREDENTIALS")
 BASE_URL = os.getenv("BASE_URL", "https://cscarpa-vps.eu/GoogleApp")
 OAUTH_REDIRECT_URI = "https://cscarpa-vps.eu/GoogleApp/oauth2callback"
 API_KEY = os.getenv("API_KEY")
+# Directory opzionale con i discovery document (es. gmail.v1.json); altrimenti si usano quelli inclusi in googleapiclient
+DISCOVERY_DIR = os.getenv("DISCOVERY_DIR")
+DISCOVERY_SERVICES = [("gmail", "v1"), ("calendar", "v3")]
+# Secondi di anticipo rispetto alla scadenza con cui il task in background aggiorna il token
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", "600"))
+TOKEN_REFRESH_RETRY = 60
+# Gmail accetta fino a 100 richieste per batch ma consiglia di non superare 50 per evitare il rate limiting
+GMAIL_BATCH_SIZE = max(1, min(int(os.getenv("GMAIL_BATCH_SIZE", "50")), 100))
+GMAIL_RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+# Header sempre richiesti a Gmail per il riepilogo dei messaggi
+SUMMARY_HEADERS = ["Subject", "From"]
+SUMMARY_FIELDS = "id,snippet,labelIds,payload/headers"
+# Limite di messages.list per singola pagina
+GMAIL_MAX_PAGE_SIZE = 500
+CALENDAR_PAGE_SIZE = 250
+# Thread dedicati alle chiamate bloccanti di googleapiclient (httplib2)
+GOOGLE_API_WORKERS = max(1, int(os.getenv("GOOGLE_API_WORKERS", "8")))
+GOOGLE_HTTP_TIMEOUT = 60
+# Backend per le chiamate frequenti (lettura email ed eventi): "googleapiclient" (httplib2 nel pool) o "httpx" (async, HTTP/2)
+GOOGLE_API_BACKEND = os.getenv("GOOGLE_API_BACKEND", "googleapiclient").lower()
+# Richieste concorrenti verso Google con il backend httpx
+GOOGLE_HTTPX_CONCURRENCY = max(1, int(os.getenv("GOOGLE_HTTPX_CONCURRENCY", "20")))
+# Allegati di un messaggio scaricati in parallelo da download_attachments
+ATTACHMENT_FETCH_CONCURRENCY = max(1, int(os.getenv("ATTACHMENT_FETCH_CONCURRENCY", "8")))
+# Email per richiesta di download multiplo e id per singolo messages.batchModify (limite Gmail: 1000)
+BULK_DOWNLOAD_MAX_MESSAGES = 500
+GMAIL_BATCH_MODIFY_SIZE = 1000
+# Dimensione dei blocchi con cui gli allegati vengono decodificati e scritti su disco
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+# Invii piu' grandi di RESUMABLE_UPLOAD_THRESHOLD byte usano l'upload ripristinabile di Gmail, a blocchi
+# di RESUMABLE_UPLOAD_CHUNK_SIZE (multiplo di 256 KiB richiesto da Google) ritentati fino a RESUMABLE_UPLOAD_RETRIES volte
+RESUMABLE_UPLOAD_THRESHOLD = int(os.getenv("RESUMABLE_UPLOAD_THRESHOLD", str(5 * 1024 * 1024)))
+RESUMABLE_UPLOAD_CHUNK_SIZE = 16 * 256 * 1024
+RESUMABLE_UPLOAD_RETRIES = 5
+# Byte letti per volta dagli allegati in uscita: multiplo di 57, cioe' righe base64 complete da 76 caratteri
+MIME_READ_SIZE = 57 * 1024
+# Riepiloghi di messaggi tenuti in memoria (LRU) e secondi dopo i quali se ne riverificano le label
+MESSAGE_CACHE_SIZE = max(0, int(os.getenv("MESSAGE_CACHE_SIZE", "5000")))
+MESSAGE_LABEL_TTL = int(os.getenv("MESSAGE_LABEL_TTL", "60"))
+# Secondi per cui i risultati di messages.list restano in cache (invalidata da invii, label e download)
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", "30"))
+QUERY_CACHE_SIZE = 1000
+# Secondi di validita' della mappa nome -> id delle label Gmail
+LABEL_CACHE_TTL = int(os.getenv("LABEL_CACHE_TTL", "600"))
+LABEL_REFRESH_MIN_INTERVAL = 5
+DOWNLOADED_LABEL = "Downloaded"
+# Mirror locale della casella (SQLite) aggiornato in modo incrementale con users.history.list
+MAILBOX_SYNC = os.getenv("MAILBOX_SYNC", "true").lower() == "true"
+MAILBOX_DB = os.getenv("MAILBOX_DB", "/var/www/ai/GoogleApp/mailbox.sqlite3")
+# Campi letti per ogni messaggio del mirror: header e struttura MIME senza i dati del corpo
+MIRROR_PART_FIELDS = "partId,mimeType,filename,body/attachmentId,body/size"
+MIRROR_FIELDS = (
+    "id,threadId,labelIds,snippet,internalDate,payload(headers," + MIRROR_PART_FIELDS
+    + ",parts(" + MIRROR_PART_FIELDS + ",parts(" + MIRROR_PART_FIELDS + ",parts(" + MIRROR_PART_FIELDS + "))))"
+)
+# Solo la struttura MIME, per trovare gli allegati di un messaggio
+ATTACHMENT_FIELDS = (
+    "payload(" + MIRROR_PART_FIELDS
+    + ",parts(" + MIRROR_PART_FIELDS + ",parts(" + MIRROR_PART_FIELDS + ",parts(" + MIRROR_PART_FIELDS + "))))"
+)
+# Risposte di read_emails dall'indice locale (FTS5) se il mirror e' stato sincronizzato da meno di MAILBOX_INDEX_MAX_AGE secondi
+MAILBOX_INDEX = os.getenv("MAILBOX_INDEX", "true").lower() == "true"
+MAILBOX_SYNC_INTERVAL = int(os.getenv("MAILBOX_SYNC_INTERVAL", "60"))
+MAILBOX_INDEX_MAX_AGE = int(os.getenv("MAILBOX_INDEX_MAX_AGE", "180"))
+# Email con allegati da scaricare a ogni giro del monitor
+MONITOR_MAX_EMAILS = 10
+GMAIL_API_URL = "https://gmail.googleapis.com/gmail/v1/users/me"
+GMAIL_UPLOAD_URL = "https://gmail.googleapis.com/upload/gmail/v1/users/me"
+CALENDAR_API_URL = "https://www.googleapis.com/calendar/v3"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
 
 class EmailRequest(BaseModel):
     to: str
@@ -62,6 +162,1876 @@ class EmailRequest(BaseModel):
     bcc: Optional[str] = None
     attachment_paths: Optional[List[str]] = None
 
+class BulkDownloadRequest(BaseModel):
+    message_ids: Optional[List[str]] = None
+    # Filtri di read_emails, usati se message_ids non e' indicato
+    Label: Optional[str] = None
+    ExcludeLabel: Optional[str] = None
+    Subject: Optional[str] = None
+    ExactSubject: Optional[str] = None
+    From: Optional[str] = None
+    Text: Optional[str] = None
+    LabelId: Optional[str] = None
+    ExcludeLabelId: Optional[str] = None
+    max_messages: int = 50
+
+
+def credentials_from_dict(creds_dict):
+    credentials = google.oauth2.credentials.Credentials(
+        token=creds_dict["token"],
+        refresh_token=creds_dict["refresh_token"],
+        token_uri=creds_dict["token_uri"],
+        client_id=creds_dict["client_id"],
+        client_secret=creds_dict["client_secret"],
+        scopes=creds_dict["scopes"]
+    )
+    # google-auth lavora con datetime naive in UTC; Credentials.to_json() scrive la scadenza con "Z"
+    if creds_dict.get("expiry"):
+        expiry = datetime.fromisoformat(creds_dict["expiry"])
+        if expiry.tzinfo is not None:
+            expiry = expiry.astimezone(timezone.utc).replace(tzinfo=None)
+        credentials.expiry = expiry
+    return credentials
+
+
+def credentials_to_dict(credentials):
+    return {
+        "token": credentials.token,
+        "refresh_token": credentials.refresh_token,
+        "token_uri": credentials.token_uri,
+        "client_id": credentials.client_id,
+        "client_secret": credentials.client_secret,
+        "scopes": credentials.scopes,
+        "expiry": credentials.expiry.isoformat() if credentials.expiry else None,
+    }
+
+
+@contextlib.contextmanager
+def token_file_lock():
+    """
+    Lock esclusivo su TOKEN_FILE.lock per coordinare refresh e scrittura del token tra piu' worker
+    """
+    if fcntl is None:
+        yield
+        return
+
+    with open(TOKEN_FILE + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def write_token_file(creds_dict):
+    """
+    Scrive TOKEN_FILE in modo atomico: file temporaneo nella stessa directory + rename
+    """
+    directory = os.path.dirname(os.path.abspath(TOKEN_FILE))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".token-", suffix=".json")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(creds_dict, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, TOKEN_FILE)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+_discovery_documents = {}
+
+
+def load_discovery_document(name, version):
+    """
+    Restituisce il discovery document gia' parsato, letto una sola volta da DISCOVERY_DIR
+    o dalla copia statica inclusa in googleapiclient (nessuna richiesta di rete).
+    """
+    key = (name, version)
+    document = _discovery_documents.get(key)
+    if document is not None:
+        return document
+
+    content = None
+    if DISCOVERY_DIR:
+        path = os.path.join(DISCOVERY_DIR, f"{name}.{version}.json")
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                content = f.read()
+    if content is None:
+        content = get_static_doc(name, version)
+    if content is None:
+        raise RuntimeError(f"Discovery document non disponibile per {name} {version}")
+
+    document = json.loads(content)
+    _discovery_documents[key] = document
+    return document
+
+
+class GoogleServiceCache:
+    """
+    Cache process-wide di credenziali e servizi Google.
+    TOKEN_FILE viene riletto e i servizi ricostruiti solo quando il file cambia (mtime/size).
+    Il refresh del token avviene una sola volta per scadenza e viene salvato su TOKEN_FILE.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._token_signature = None
+        self._credentials = None
+        self._services = {}
+        self.last_refresh = None
+        self.last_refresh_error = None
+
+    @staticmethod
+    def _current_signature():
+        stat = os.stat(TOKEN_FILE)
+        return (TOKEN_FILE, stat.st_mtime_ns, stat.st_size)
+
+    def _reload_if_changed(self):
+        signature = self._current_signature()
+        if signature == self._token_signature:
+            return
+
+        with open(TOKEN_FILE, "r") as token:
+            creds_dict = json.load(token)
+
+        self._credentials = credentials_from_dict(creds_dict)
+        self._services = {}
+        self._token_signature = signature
+        logger.info(f"Credenziali caricate da {TOKEN_FILE}")
+
+    def _seconds_to_expiry(self):
+        if self._credentials is None or self._credentials.expiry is None:
+            return None
+        return (self._credentials.expiry - datetime.utcnow()).total_seconds()
+
+    def _needs_refresh(self, margin=0):
+        # Senza expiry (token salvati prima di questa versione) si fa un refresh per conoscerla
+        if self._credentials.expiry is None or not self._credentials.valid:
+            return True
+        return self._seconds_to_expiry() <= margin
+
+    def _refresh(self, margin=0):
+        with token_file_lock():
+            # Un altro worker potrebbe aver gia' aggiornato TOKEN_FILE mentre si attendeva il lock
+            self._reload_if_changed()
+            if not self._needs_refresh(margin):
+                return
+
+            try:
+                self._credentials.refresh(google.auth.transport.requests.Request())
+            except Exception as e:
+                self.last_refresh_error = str(e)
+                raise
+            write_token_file(credentials_to_dict(self._credentials))
+            self._token_signature = self._current_signature()
+            self.last_refresh = datetime.utcnow()
+            self.last_refresh_error = None
+            logger.info(f"Token OAuth aggiornato, nuova scadenza {self._credentials.expiry.isoformat()}")
+
+    def _ensure_valid(self, margin=0):
+        self._reload_if_changed()
+        if self._needs_refresh(margin):
+            self._refresh(margin)
+
+    def refresh_if_expiring(self, margin):
+        """
+        Aggiorna il token se scade entro margin secondi; restituisce i secondi rimanenti alla scadenza
+        """
+        with self._lock:
+            self._ensure_valid(margin)
+            return self._seconds_to_expiry()
+
+    def token_status(self):
+        with self._lock:
+            expires_in = self._seconds_to_expiry()
+            return {
+                "expiry": self._credentials.expiry.isoformat() + "Z" if expires_in is not None else None,
+                "expires_in_seconds": int(expires_in) if expires_in is not None else None,
+                "last_refresh": self.last_refresh.isoformat() + "Z" if self.last_refresh else None,
+                "last_refresh_error": self.last_refresh_error,
+            }
+
+    def credentials(self):
+        with self._lock:
+            self._ensure_valid()
+            return self._credentials
+
+    def service(self, name, version):
+        with self._lock:
+            self._ensure_valid()
+            key = (name, version)
+            if key not in self._services:
+                self._services[key] = build_from_document(
+                    load_discovery_document(name, version), credentials=self._credentials
+                )
+            return self._services[key]
+
+    def current_credentials(self):
+        """
+        Credenziali gia' in memoria, senza I/O ne' lock (None se non ancora caricate)
+        """
+        return self._credentials
+
+    def invalidate(self):
+        with self._lock:
+            self._token_signature = None
+            self._credentials = None
+            self._services = {}
+
+
+google_services = GoogleServiceCache()
+
+google_executor = ThreadPoolExecutor(max_workers=GOOGLE_API_WORKERS, thread_name_prefix="google-api")
+_thread_local = threading.local()
+
+
+def thread_http():
+    """
+    httplib2 non e' thread-safe: ogni thread del pool usa il proprio trasporto autenticato,
+    ricreato quando cambiano le credenziali
+    """
+    credentials = google_services.credentials()
+    http = getattr(_thread_local, "http", None)
+    if http is None or http.credentials is not credentials:
+        http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT))
+        _thread_local.http = http
+    return http
+
+def execute_request(request):
+    return request.execute(http=thread_http())
+
+async def run_google(func, *args, **kwargs):
+    """
+    Esegue una funzione bloccante nel pool google_executor, senza bloccare l'event loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(google_executor, functools.partial(func, *args, **kwargs))
+
+async def iterate_in_pool(iterator):
+    """
+    Consuma un iteratore bloccante (lettura di file, decodifica) nel pool google_executor, un elemento alla volta
+    """
+    while True:
+        item = await run_google(next, iterator, None)
+        if item is None:
+            return
+        yield item
+
+async def google_execute(request):
+    return await run_google(execute_request, request)
+
+async def google_service(name, version):
+    # Il primo accesso puo' leggere TOKEN_FILE o aggiornare il token: anche questo fuori dall'event loop
+    return await run_google(google_services.service, name, version)
+
+def raise_http_error(response):
+    raise HttpError(
+        resp=httplib2.Response({"status": response.status_code}),
+        content=response.content,
+        uri=str(response.url)
+    )
+
+class GoogleAsyncClient:
+    """
+    Backend alternativo su un httpx.AsyncClient condiviso (HTTP/2 e keep-alive) per le chiamate frequenti:
+    le richieste concorrenti sono coroutine sulla stessa connessione, senza thread ne' handshake TLS ripetuti.
+    Gli errori HTTP sono sollevati come HttpError, come con googleapiclient.
+    """
+
+    def __init__(self):
+        self._client = None
+        self._semaphore = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                timeout=GOOGLE_HTTP_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=GOOGLE_HTTPX_CONCURRENCY,
+                    max_keepalive_connections=GOOGLE_HTTPX_CONCURRENCY
+                )
+            )
+            self._semaphore = asyncio.Semaphore(GOOGLE_HTTPX_CONCURRENCY)
+        return self._client
+
+    async def authorization_header(self):
+        credentials = google_services.current_credentials()
+        if credentials is None or not credentials.valid:
+            credentials = await run_google(google_services.credentials)
+        return {"Authorization": f"Bearer {credentials.token}"}
+
+    async def request(self, method, url, params=None, json_body=None):
+        client = self.client
+        if params:
+            params = {key: value for key, value in params.items() if value is not None}
+
+        async with self._semaphore:
+            for attempt in range(2):
+                response = await client.request(
+                    method, url, params=params, json=json_body, headers=await self.authorization_header()
+                )
+                if response.status_code != 401 or attempt:
+                    break
+                # Token revocato o aggiornato da un altro worker: si ricarica TOKEN_FILE e si riprova una volta
+                google_services.invalidate()
+
+        if response.status_code >= 400:
+            raise_http_error(response)
+        return response.json() if response.content else {}
+
+    async def upload(self, url, f, size, content_type, params=None):
+        """
+        POST del contenuto di f (dall'inizio, size byte) letto a blocchi, senza caricarlo in memoria
+        """
+        client = self.client
+
+        async def content():
+            await run_google(f.seek, 0)
+            while True:
+                chunk = await run_google(f.read, ATTACHMENT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+        async with self._semaphore:
+            for attempt in range(2):
+                headers = {
+                    **await self.authorization_header(),
+                    "Content-Type": content_type,
+                    "Content-Length": str(size)
+                }
+                response = await client.request("POST", url, params=params, content=content(), headers=headers)
+                if response.status_code != 401 or attempt:
+                    break
+                google_services.invalidate()
+
+        if response.status_code >= 400:
+            raise_http_error(response)
+        return response.json() if response.content else {}
+
+    async def upload_resumable(self, url, f, size, content_type, params=None):
+        """
+        Upload ripristinabile di f a blocchi di RESUMABLE_UPLOAD_CHUNK_SIZE: dopo un errore temporaneo si chiede
+        a Google quanti byte ha ricevuto e si riprende da li', invece di ricominciare da capo.
+        Il semaforo condiviso e' occupato solo durante le singole richieste, non durante le attese tra i tentativi.
+        """
+        client = self.client
+        params = {**(params or {}), "uploadType": "resumable"}
+
+        for attempt in range(RESUMABLE_UPLOAD_RETRIES + 1):
+            try:
+                headers = {
+                    **await self.authorization_header(),
+                    "X-Upload-Content-Type": content_type,
+                    "X-Upload-Content-Length": str(size),
+                    "Content-Length": "0"
+                }
+                async with self._semaphore:
+                    response = await client.post(url, params=params, headers=headers)
+            except httpx.TransportError:
+                if attempt == RESUMABLE_UPLOAD_RETRIES:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+                continue
+            if response.status_code == 401:
+                google_services.invalidate()
+            elif response.status_code not in GMAIL_RETRYABLE_STATUSES or attempt == RESUMABLE_UPLOAD_RETRIES:
+                break
+            await asyncio.sleep(2 ** attempt)
+        if response.status_code >= 400:
+            raise_http_error(response)
+        session_url = response.headers["Location"]
+
+        offset = 0
+        failures = 0
+        query_status = False
+        while True:
+            try:
+                headers = await self.authorization_header()
+                if query_status:
+                    # Stato della sessione: quanti byte sono arrivati
+                    headers["Content-Range"] = f"bytes */{size}"
+                    chunk = b""
+                else:
+                    await run_google(f.seek, offset)
+                    chunk = await run_google(f.read, min(RESUMABLE_UPLOAD_CHUNK_SIZE, size - offset))
+                    headers["Content-Range"] = (
+                        f"bytes {offset}-{offset + len(chunk) - 1}/{size}" if chunk else f"bytes */{size}"
+                    )
+                async with self._semaphore:
+                    response = await client.put(session_url, content=chunk, headers=headers)
+            except httpx.TransportError as e:
+                response = None
+                error = e
+
+            if response is not None and response.status_code in (200, 201):
+                return response.json() if response.content else {}
+            if response is not None and response.status_code == 308:
+                # Range assente: nessun byte ricevuto
+                received = response.headers.get("Range")
+                offset = int(received.rsplit("-", 1)[1]) + 1 if received else 0
+                if not query_status:
+                    failures = 0
+                query_status = False
+                continue
+            if response is not None and response.status_code not in GMAIL_RETRYABLE_STATUSES + (401,):
+                raise_http_error(response)
+
+            failures += 1
+            if failures > RESUMABLE_UPLOAD_RETRIES:
+                if response is None:
+                    raise error
+                raise_http_error(response)
+            if response is not None and response.status_code == 401:
+                google_services.invalidate()
+            logger.warning(f"Upload interrotto a {offset}/{size} byte, nuovo tentativo ({failures})")
+            await asyncio.sleep(min(2 ** (failures - 1), 30))
+            query_status = True
+
+    @contextlib.asynccontextmanager
+    async def stream(self, method, url, params=None):
+        """
+        Come request, ma restituisce la risposta senza leggerne il corpo (da consumare con aiter_bytes).
+        Il semaforo copre solo l'invio: il corpo e' letto al ritmo del client e non deve occupare posti
+        """
+        client = self.client
+        for attempt in range(2):
+            request = client.build_request(method, url, params=params, headers=await self.authorization_header())
+            async with self._semaphore:
+                response = await client.send(request, stream=True)
+            if response.status_code != 401 or attempt:
+                break
+            await response.aclose()
+            google_services.invalidate()
+
+        try:
+            if response.status_code >= 400:
+                await response.aread()
+                raise_http_error(response)
+            yield response
+        finally:
+            await response.aclose()
+
+    async def get_messages(self, message_ids, **get_params):
+        """
+        Come batch_get_messages, ma con richieste concorrenti: (messaggi per id, errori per id)
+        """
+        messages = {}
+        errors = {}
+
+        async def fetch(message_id):
+            for attempt in range(2):
+                try:
+                    messages[message_id] = await self.request(
+                        "GET", f"{GMAIL_API_URL}/messages/{message_id}", params=get_params
+                    )
+                    return
+                except HttpError as e:
+                    if attempt == 0 and e.resp.status in GMAIL_RETRYABLE_STATUSES:
+                        await asyncio.sleep(1)
+                        continue
+                    errors[message_id] = str(e)
+                    return
+                except httpx.HTTPError as e:
+                    errors[message_id] = str(e)
+                    return
+
+        await asyncio.gather(*(fetch(message_id) for message_id in dict.fromkeys(message_ids)))
+        return messages, errors
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+google_http = GoogleAsyncClient()
+
+
+class SingleFlight:
+    """
+    Coalescenza delle chiamate identiche in corso: chi arriva mentre una chiamata con la stessa chiave
+    e' in volo ne attende il risultato invece di ripeterla.
+    La chiamata gira in un task separato, quindi la disconnessione del primo client non la annulla per gli altri.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def run_many(self, keys, fetch):
+        """
+        fetch(chiavi) -> {chiave: risultato} viene chiamata una sola volta, per le sole chiavi non gia' in volo
+        """
+        loop = asyncio.get_running_loop()
+        futures = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            future = self._inflight.get(key)
+            if future is None:
+                future = loop.create_future()
+                self._inflight[key] = future
+                missing.append(key)
+            else:
+                self.shared += 1
+            futures[key] = future
+
+        if missing:
+            self.calls += 1
+            task = asyncio.ensure_future(fetch(missing))
+
+            def resolve(task, missing=missing):
+                for key in missing:
+                    future = self._inflight.pop(key)
+                    if task.cancelled():
+                        future.cancel()
+                    elif task.exception() is not None:
+                        future.set_exception(task.exception())
+                    else:
+                        future.set_result(task.result().get(key))
+
+            task.add_done_callback(resolve)
+
+        return {key: await asyncio.shield(future) for key, future in futures.items()}
+
+    async def run(self, key, fetch):
+        results = await self.run_many([key], lambda keys: self._single(fetch, keys[0]))
+        return results[key]
+
+    @staticmethod
+    async def _single(fetch, key):
+        return {key: await fetch()}
+
+    def stats(self):
+        return {"in_flight": len(self._inflight), "calls": self.calls, "shared": self.shared}
+
+
+google_inflight = SingleFlight()
+
+
+def inflight_key(operation, params):
+    return operation, json.dumps(params, sort_keys=True, default=str)
+
+async def gmail_list_messages(service, **params):
+    async def fetch():
+        if GOOGLE_API_BACKEND == "httpx":
+            return await google_http.request("GET", f"{GMAIL_API_URL}/messages", params=params)
+        return await google_execute(service.users().messages().list(userId="me", **params))
+
+    return await google_inflight.run(inflight_key("messages.list", params), fetch)
+
+async def gmail_get_messages(service, message_ids, **get_params):
+    """
+    (messaggi per id, errori per id); gli id gia' richiesti con gli stessi parametri da un'altra richiesta
+    in corso non vengono letti di nuovo
+    """
+    params_key = inflight_key("messages.get", get_params)
+
+    async def fetch(keys):
+        ids = [key[1] for key in keys]
+        if GOOGLE_API_BACKEND == "httpx":
+            fetched, errors = await google_http.get_messages(ids, **get_params)
+        else:
+            fetched, errors = await run_google(batch_get_messages, service, ids, **get_params)
+        return {key: (fetched.get(key[1]), errors.get(key[1])) for key in keys}
+
+    results = await google_inflight.run_many([(params_key, message_id) for message_id in message_ids], fetch)
+    fetched = {key[1]: message for key, (message, error) in results.items() if message is not None}
+    errors = {key[1]: error for key, (message, error) in results.items() if error is not None}
+    return fetched, errors
+
+async def calendar_list_events(service, calendarId, **params):
+    async def fetch():
+        if GOOGLE_API_BACKEND == "httpx":
+            return await google_http.request("GET", f"{CALENDAR_API_URL}/calendars/{calendarId}/events", params=params)
+        return await google_execute(service.events().list(calendarId=calendarId, **params))
+
+    return await google_inflight.run(inflight_key("events.list", {"calendarId": calendarId, **params}), fetch)
+
+async def iter_attachment_data(service, message_id, attachment_id):
+    """
+    Byte decodificati di un allegato, a blocchi; con il backend httpx anche la risposta di Gmail
+    viene letta in streaming, senza tenere in memoria ne' il base64 ne' il file decodificato
+    """
+    if GOOGLE_API_BACKEND != "httpx":
+        attachment = await google_execute(service.users().messages().attachments().get(
+            userId="me", messageId=message_id, id=attachment_id, fields="data"
+        ))
+        async for chunk in iterate_in_pool(iter_base64_chunks(attachment["data"])):
+            yield chunk
+        return
+
+    url = f"{GMAIL_API_URL}/messages/{message_id}/attachments/{attachment_id}"
+    reader = JsonStringFieldReader("data")
+    decoder = Base64UrlDecoder()
+    async with google_http.stream("GET", url, params={"fields": "data"}) as response:
+        async for chunk in response.aiter_bytes(ATTACHMENT_CHUNK_SIZE):
+            data = decoder.feed(reader.feed(chunk))
+            if data:
+                yield data
+        if not reader.done:
+            raise ValueError(f"Risposta di Gmail senza dati per l'allegato {attachment_id}")
+        data = decoder.finish()
+        if data:
+            yield data
+
+async def download_attachment(service, message_id, attachment_id, f):
+    """
+    Scrive in f l'allegato decodificato; decodifica, hash e scrittura avvengono nel pool google_executor
+    """
+    if GOOGLE_API_BACKEND != "httpx":
+        attachment = await google_execute(service.users().messages().attachments().get(
+            userId="me", messageId=message_id, id=attachment_id, fields="data"
+        ))
+        await run_google(write_base64, attachment["data"], f)
+        return
+
+    async for chunk in iter_attachment_data(service, message_id, attachment_id):
+        await run_google(f.write, chunk)
+
+def batch_get_messages(service, message_ids, not_found=None, **get_params):
+    """
+    Recupera piu' messaggi con richieste batch Gmail (GMAIL_BATCH_SIZE per batch).
+    Restituisce (messaggi per id, errori per id); gli errori temporanei vengono ritentati una volta.
+    Se not_found e' un set, vi vengono aggiunti gli id per cui Gmail risponde 404.
+    """
+    messages = {}
+    errors = {}
+    pending = list(dict.fromkeys(message_ids))
+
+    for attempt in range(2):
+        retry = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                messages[request_id] = response
+                return
+            status = getattr(getattr(exception, "resp", None), "status", None)
+            if attempt == 0 and status in GMAIL_RETRYABLE_STATUSES:
+                retry.append(request_id)
+            else:
+                errors[request_id] = str(exception)
+                if status == 404 and not_found is not None:
+                    not_found.add(request_id)
+
+        for start in range(0, len(pending), GMAIL_BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=callback)
+            for message_id in pending[start:start + GMAIL_BATCH_SIZE]:
+                batch.add(
+                    service.users().messages().get(userId="me", id=message_id, **get_params),
+                    request_id=message_id
+                )
+            batch.execute(http=thread_http())
+
+        if not retry:
+            break
+        logger.warning(f"Batch Gmail: nuovo tentativo per {len(retry)} messaggi")
+        time.sleep(1)
+        pending = retry
+
+    return messages, errors
+
+def parse_header_names(headers):
+    """
+    "Date, To,Message-ID" -> ["Date", "To", "Message-ID"], senza duplicati (case-insensitive)
+    """
+    names = {}
+    for name in (headers or "").split(","):
+        name = name.strip()
+        if name:
+            names.setdefault(name.lower(), name)
+    return list(names.values())
+
+def summary_get_params(extra_headers=()):
+    """
+    Parametri di messages.get per il riepilogo: solo metadata, header richiesti e campi proiettati
+    """
+    metadata_headers = parse_header_names(",".join(SUMMARY_HEADERS + list(extra_headers)))
+    return {"format": "metadata", "metadataHeaders": metadata_headers, "fields": SUMMARY_FIELDS}
+
+def summarize_message(msg, extra_headers=()):
+    header_values = {}
+    for header in msg.get("payload", {}).get("headers", []):
+        header_values.setdefault(header["name"].lower(), header["value"])
+
+    summary = {
+        "id": msg["id"],
+        "snippet": msg.get("snippet", ""),
+        "subject": header_values.get("subject", "No Subject"),
+        "from": header_values.get("from", "Unknown Sender"),
+        "labels": msg.get("labelIds", [])
+    }
+    if extra_headers:
+        summary["headers"] = {name: header_values.get(name.lower()) for name in extra_headers}
+    return summary
+
+class MessageSummaryCache:
+    """
+    LRU dei messaggi gia' letti (metadata proiettati), per id.
+    Un messaggio Gmail non cambia mai tranne le label, che vengono riverificate dopo MESSAGE_LABEL_TTL secondi.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.label_refreshes = 0
+
+    def get(self, message_id, header_names):
+        """
+        Restituisce (messaggio, label da riverificare) oppure (None, False) se manca o non ha tutti gli header richiesti
+        """
+        wanted = {name.lower() for name in header_names}
+        with self._lock:
+            entry = self._entries.get(message_id)
+            if entry is None or not wanted <= entry["headers"]:
+                self.misses += 1
+                return None, False
+            self._entries.move_to_end(message_id)
+            self.hits += 1
+            return entry["message"], time.monotonic() - entry["checked"] > MESSAGE_LABEL_TTL
+
+    def put(self, message, header_names):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[message["id"]] = {
+                "message": message,
+                "headers": {name.lower() for name in header_names},
+                "checked": time.monotonic()
+            }
+            self._entries.move_to_end(message["id"])
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def update_labels(self, message_id, label_ids):
+        with self._lock:
+            entry = self._entries.get(message_id)
+            if entry is not None:
+                entry["message"] = {**entry["message"], "labelIds": label_ids}
+                entry["checked"] = time.monotonic()
+
+    def discard(self, message_id):
+        with self._lock:
+            self._entries.pop(message_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "label_refreshes": self.label_refreshes
+            }
+
+
+message_cache = MessageSummaryCache(MESSAGE_CACHE_SIZE)
+
+
+async def get_message_summaries(service, message_ids, extra_headers=()):
+    """
+    Riepiloghi dei messaggi, dalla cache quando possibile.
+    Solo i messaggi mancanti vengono letti per intero (metadata); per quelli in cache con label scadute
+    si chiede a Gmail soltanto labelIds. Restituisce (riepiloghi per id, errori per id).
+    """
+    get_params = summary_get_params(extra_headers)
+    cached = {}
+    to_fetch = []
+    to_relabel = []
+    for message_id in message_ids:
+        message, stale_labels = message_cache.get(message_id, get_params["metadataHeaders"])
+        if message is None:
+            to_fetch.append(message_id)
+            continue
+        cached[message_id] = message
+        if stale_labels:
+            to_relabel.append(message_id)
+
+    errors = {}
+    if to_fetch:
+        fetched, fetch_errors = await gmail_get_messages(service, to_fetch, **get_params)
+        errors.update(fetch_errors)
+        for message in fetched.values():
+            message_cache.put(message, get_params["metadataHeaders"])
+        cached.update(fetched)
+
+    if to_relabel:
+        relabeled, relabel_errors = await gmail_get_messages(
+            service, to_relabel, format="minimal", fields="id,labelIds"
+        )
+        message_cache.label_refreshes += len(relabeled)
+        for message_id, message in relabeled.items():
+            message_cache.update_labels(message_id, message.get("labelIds", []))
+            cached[message_id] = {**cached[message_id], "labelIds": message.get("labelIds", [])}
+        for message_id, error in relabel_errors.items():
+            # Probabilmente eliminato: non lo si restituisce piu'
+            message_cache.discard(message_id)
+            cached.pop(message_id, None)
+            errors[message_id] = error
+
+    summaries = {
+        message_id: summarize_message(message, extra_headers)
+        for message_id, message in cached.items()
+    }
+    return summaries, errors
+
+def email_filters(Label=None, ExcludeLabel=None, Subject=None, ExactSubject=None, HasAttachment=False, From=None, Text=None,
+                  LabelId=None, ExcludeLabelId=None):
+    return {
+        "label": Label, "exclude_label": ExcludeLabel, "subject": Subject, "exact_subject": ExactSubject,
+        "has_attachment": HasAttachment, "sender": From, "text": Text,
+        "label_id": LabelId, "exclude_label_id": ExcludeLabelId
+    }
+
+def gmail_label_term(name):
+    # Nella ricerca Gmail spazi e "/" dei nomi di label diventano "-"
+    return re.sub(r"[\s/]+", "-", name)
+
+def build_gmail_query(filters):
+    """
+    Query Gmail per i filtri testuali; label_id / exclude_label_id vanno risolti prima (vedi resolve_label_filters)
+    """
+    query_string = ""
+    if filters.get("label"):
+        query_string += f"label:{gmail_label_term(filters['label'])} "
+    if filters.get("exclude_label"):
+        query_string += f"-label:{gmail_label_term(filters['exclude_label'])} "
+    if filters.get("subject"):
+        query_string += f"subject:{filters['subject']} "
+    if filters.get("exact_subject"):
+        query_string += f'subject:"{filters["exact_subject"]}" '
+    if filters.get("has_attachment"):
+        query_string += "has:attachment "
+    if filters.get("sender"):
+        query_string += f"from:{filters['sender']} "
+    if filters.get("text"):
+        query_string += f'"{filters["text"]}" '
+    return query_string.strip()
+
+def filters_scope(filters):
+    """
+    Rappresentazione canonica dei filtri, a cui sono legati i cursori di read_emails
+    """
+    return json.dumps(query_cache_key(filters, None, None)[0])
+
+def query_cache_key(filters, page_size, page_token):
+    """
+    Chiave canonica di una ricerca: la ricerca Gmail non distingue maiuscole e spazi ripetuti
+    """
+    normalized = tuple(sorted(
+        (name, " ".join(str(value).split()).lower())
+        for name, value in filters.items()
+        if value
+    ))
+    return normalized, page_size, page_token or None
+
+
+class QueryResultCache:
+    """
+    Risultati di messages.list (id e nextPageToken) per chiave canonica, validi QUERY_CACHE_TTL secondi.
+    Viene svuotata quando questo servizio modifica la casella (invio, label, download) o il sync rileva modifiche.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry["stored"] > self.ttl:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry["value"]
+
+    def put(self, key, value, generation):
+        """
+        Salva solo se nel frattempo la cache non e' stata invalidata (generation invariata)
+        """
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = {"value": value, "stored": time.monotonic()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations
+            }
+
+
+query_cache = QueryResultCache(QUERY_CACHE_TTL, QUERY_CACHE_SIZE)
+
+
+class LabelDirectory:
+    """
+    Label Gmail per nome e per id, rilette da labels.list ogni LABEL_CACHE_TTL secondi
+    o quando si cerca un nome sconosciuto
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._by_id = {}
+        self._by_name = {}
+        self._loaded_at = None
+        self.refreshes = 0
+
+    @staticmethod
+    def _normalize(name):
+        return gmail_label_term(name).lower()
+
+    def _store(self, labels):
+        self._by_id = {label["id"]: label for label in labels}
+        self._by_name = {self._normalize(label["name"]): label for label in labels}
+        self._loaded_at = time.monotonic()
+
+    async def refresh(self, service):
+        async def fetch():
+            return await google_execute(service.users().labels().list(userId="me"))
+
+        result = await google_inflight.run(("labels.list",), fetch)
+        self._store(result.get("labels", []))
+        self.refreshes += 1
+
+    def _age(self):
+        return None if self._loaded_at is None else time.monotonic() - self._loaded_at
+
+    def _lookup(self, name_or_id):
+        return self._by_id.get(name_or_id) or self._by_name.get(self._normalize(name_or_id))
+
+    async def get(self, service, name_or_id):
+        """
+        Label per id o per nome (senza distinzione di maiuscole), None se non esiste
+        """
+        age = self._age()
+        if age is None or age > self.ttl:
+            await self.refresh(service)
+        label = self._lookup(name_or_id)
+        if label is None and self._age() > LABEL_REFRESH_MIN_INTERVAL:
+            await self.refresh(service)
+            label = self._lookup(name_or_id)
+        return label
+
+    async def get_or_create(self, service, name):
+        label = await self.get(service, name)
+        if label is not None:
+            return label
+
+        new_label = {
+            "name": name,
+            "labelListVisibility": "labelShow",
+            "messageListVisibility": "show"
+        }
+        try:
+            label = await google_execute(service.users().labels().create(userId="me", body=new_label))
+        except HttpError as e:
+            # Creata nel frattempo da un'altra richiesta
+            if getattr(e.resp, "status", None) != 409:
+                raise
+            await self.refresh(service)
+            return self._lookup(name)
+
+        self._by_id[label["id"]] = label
+        self._by_name[self._normalize(label["name"])] = label
+        return label
+
+    def stats(self):
+        age = self._age()
+        return {"size": len(self._by_id), "age_seconds": int(age) if age is not None else None,
+                "refreshes": self.refreshes}
+
+
+label_directory = LabelDirectory(LABEL_CACHE_TTL)
+
+
+async def resolve_label_filters(service, filters):
+    """
+    Converte i filtri di label nella forma migliore per messages.list: le label incluse diventano labelIds
+    (se il nome e' noto), quelle escluse per id diventano -label:nome. Restituisce (query, labelIds).
+    """
+    filters = dict(filters)
+    label_ids = []
+    if filters.get("label_id"):
+        label_ids.append(filters["label_id"])
+    if filters.get("label"):
+        label = await label_directory.get(service, filters["label"])
+        if label is not None:
+            label_ids.append(label["id"])
+            filters["label"] = None
+    if filters.get("exclude_label_id"):
+        label = await label_directory.get(service, filters["exclude_label_id"])
+        if label is None:
+            raise HTTPException(status_code=400, detail=f"Label non trovata: {filters['exclude_label_id']}")
+        if not filters.get("exclude_label"):
+            filters["exclude_label"] = label["name"]
+        else:
+            query_suffix = f" -label:{gmail_label_term(label['name'])}"
+            return build_gmail_query(filters) + query_suffix, label_ids
+    return build_gmail_query(filters), label_ids
+
+async def search_messages(service, filters, page_size, page_token=None):
+    """
+    messages.list per i filtri di read_emails, con cache dei risultati per chiave canonica
+    """
+    key = query_cache_key(filters, page_size, page_token)
+    results = query_cache.get(key)
+    if results is None:
+        generation = query_cache.generation
+        query, label_ids = await resolve_label_filters(service, filters)
+        results = await gmail_list_messages(
+            service, maxResults=page_size, q=query, pageToken=page_token, labelIds=label_ids or None
+        )
+        query_cache.put(key, results, generation)
+    return results
+
+def query_fingerprint(query):
+    return hashlib.sha256(query.encode("utf-8")).hexdigest()[:16]
+
+def encode_cursor(query, page_token, source="gmail"):
+    """
+    Cursore opaco: page token Gmail (o offset nell'indice locale) legato alla query che l'ha prodotto
+    """
+    if not page_token:
+        return None
+    data = json.dumps({"q": query_fingerprint(query), "t": page_token, "s": source}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode().rstrip("=")
+
+def decode_cursor(cursor, query):
+    """
+    Restituisce (page token, sorgente) del cursore; 400 se il cursore non e' valido o appartiene a un'altra query
+    """
+    if not cursor:
+        return None, None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode("utf-8")))
+        page_token = data["t"]
+        fingerprint = data["q"]
+        source = data.get("s", "gmail")
+        if source not in ("gmail", "index"):
+            raise ValueError(source)
+        # Per l'indice il token e' un offset: intero non negativo
+        if source == "index" and not (isinstance(page_token, str) and page_token.isdecimal()):
+            raise ValueError(page_token)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise HTTPException(status_code=400, detail="Cursore non valido.")
+    if fingerprint != query_fingerprint(query):
+        raise HTTPException(status_code=400, detail="Il cursore non corrisponde ai filtri della ricerca.")
+    return page_token, source
+
+def ndjson_line(item):
+    return json.dumps(item, ensure_ascii=False, default=str) + "\n"
+
+async def stream_email_summaries(service, filters, query, page_token, max_results, extra_headers):
+    """
+    Genera i riepiloghi in NDJSON pagina per pagina e batch per batch, man mano che Gmail risponde.
+    L'ultima riga contiene next_cursor.
+    """
+    remaining = max_results
+    try:
+        while remaining > 0:
+            results = await search_messages(service, filters, min(remaining, GMAIL_MAX_PAGE_SIZE), page_token)
+            message_ids = [message["id"] for message in results.get("messages", [])]
+            page_token = results.get("nextPageToken")
+            remaining -= len(message_ids)
+
+            for start in range(0, len(message_ids), GMAIL_BATCH_SIZE):
+                chunk = message_ids[start:start + GMAIL_BATCH_SIZE]
+                summaries, errors = await get_message_summaries(service, chunk, extra_headers)
+                for message_id in chunk:
+                    if message_id in summaries:
+                        yield ndjson_line(summaries[message_id])
+                    elif message_id in errors:
+                        yield ndjson_line({"id": message_id, "error": errors[message_id]})
+
+            if not page_token or not message_ids:
+                break
+
+        yield ndjson_line({"next_cursor": encode_cursor(query, page_token)})
+    except Exception as e:
+        # Lo stato HTTP e' gia' stato inviato: l'errore viene segnalato come ultima riga
+        traceback.print_exc()
+        yield ndjson_line({"error": f"Error reading emails: {str(e)}"})
+
+async def stream_index_summaries(filters, query, offset, max_results):
+    """
+    Come stream_email_summaries, ma dall'indice locale
+    """
+    remaining = max_results
+    try:
+        while remaining > 0:
+            emails, has_more = await run_google(
+                mailbox_mirror.search, filters, min(remaining, GMAIL_MAX_PAGE_SIZE), offset
+            )
+            for email in emails:
+                yield ndjson_line(email)
+            offset += len(emails)
+            remaining -= len(emails)
+            if not has_more or not emails:
+                offset = None
+                break
+
+        yield ndjson_line({"next_cursor": encode_cursor(query, offset and str(offset), "index")})
+    except Exception as e:
+        traceback.print_exc()
+        yield ndjson_line({"error": f"Error reading emails: {str(e)}"})
+
+async def stream_calendar_events(service, list_params, max_results):
+    """
+    Genera gli eventi in NDJSON pagina per pagina
+    """
+    remaining = max_results
+    page_token = None
+    try:
+        while remaining > 0:
+            events_result = await calendar_list_events(
+                service, maxResults=min(remaining, CALENDAR_PAGE_SIZE), pageToken=page_token, **list_params
+            )
+            events = events_result.get("items", [])[:remaining]
+            for event in events:
+                yield ndjson_line(event)
+            remaining -= len(events)
+            page_token = events_result.get("nextPageToken")
+            if not page_token or not events:
+                break
+    except Exception as e:
+        traceback.print_exc()
+        yield ndjson_line({"error": f"Error reading reminders: {str(e)}"})
+
+class Base64UrlDecoder:
+    """
+    Decodifica base64url a blocchi: i caratteri oltre l'ultimo multiplo di 4 passano al blocco successivo
+    """
+
+    def __init__(self):
+        self._pending = b""
+
+    def feed(self, chunk):
+        data = self._pending + chunk
+        usable = len(data) - len(data) % 4
+        self._pending = data[usable:]
+        return base64.urlsafe_b64decode(data[:usable])
+
+    def finish(self):
+        data, self._pending = self._pending, b""
+        if not data:
+            return b""
+        return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+class JsonStringFieldReader:
+    """
+    Estrae a blocchi il valore di un campo stringa da un JSON letto in streaming.
+    Adatto solo a valori senza escape, come il base64url degli allegati Gmail.
+    """
+
+    def __init__(self, field):
+        self._pattern = re.compile(rb'"' + re.escape(field.encode()) + rb'"\s*:\s*"')
+        self._head = b""
+        self.started = False
+        self.done = False
+
+    def feed(self, chunk):
+        if self.done:
+            return b""
+        if not self.started:
+            self._head += chunk
+            match = self._pattern.search(self._head)
+            if match is None:
+                return b""
+            self.started = True
+            chunk, self._head = self._head[match.end():], b""
+        end = chunk.find(b'"')
+        if end >= 0:
+            self.done = True
+            return chunk[:end]
+        return chunk
+
+def write_base64(data, f):
+    for chunk in iter_base64_chunks(data):
+        f.write(chunk)
+
+def iter_base64_chunks(data):
+    decoder = Base64UrlDecoder()
+    for start in range(0, len(data), ATTACHMENT_CHUNK_SIZE):
+        yield decoder.feed(data[start:start + ATTACHMENT_CHUNK_SIZE].encode("ascii"))
+    yield decoder.finish()
+
+def iter_attachment_parts(parts):
+    """
+    Parti MIME con filename e attachmentId, in profondita'
+    """
+    for part in parts:
+        if part.get("parts"):
+            yield from iter_attachment_parts(part["parts"])
+        elif part.get("filename") and part.get("body", {}).get("attachmentId"):
+            yield part
+
+def attachment_parts(message):
+    """
+    Allegati di un messaggio; un payload non multipart con filename (es. un PDF inviato da solo) e' l'allegato stesso
+    """
+    payload = message.get("payload", {})
+    return list(iter_attachment_parts(payload.get("parts") or [payload]))
+
+def safe_file_name(name, fallback):
+    """
+    Nome di file utilizzabile in una directory locale (niente percorsi, ne' nomi vuoti o speciali)
+    """
+    name = os.path.basename((name or "").replace("\\", "/")).strip()
+    return fallback if name in ("", ".", "..") else name
+
+def attachment_file_names(parts):
+    """
+    Nome locale per ciascuna parte: i nomi ripetuti nello stesso messaggio ricevono l'id della parte
+    """
+    names = {}
+    for part in parts:
+        part_id = part.get("partId") or str(len(names))
+        name = safe_file_name(part.get("filename"), f"attachment-{part_id}")
+        if name in names.values():
+            stem, extension = os.path.splitext(name)
+            name = f"{stem} ({part_id}){extension}"
+        names[part_id] = name
+    return list(names.values())
+
+class BlobWriter:
+    def __init__(self, f):
+        self._f = f
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.sha256 = None
+
+    def write(self, data):
+        self._f.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+
+class AttachmentStore:
+    """
+    Allegati salvati una sola volta per contenuto (SHA-256) in store_dir. In root/<message_id>/ ci sono
+    solo hardlink ai blob: gli allegati ripetuti non occupano altro spazio e file con lo stesso nome
+    di email diverse non si sovrascrivono.
+    """
+
+    MANIFEST_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS parts (
+            message_id TEXT NOT NULL,
+            part_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            attachment_id TEXT,
+            filename TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            PRIMARY KEY (message_id, part_id)
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id TEXT PRIMARY KEY,
+            part_count INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, root, store_dir):
+        self.root = root
+        self.store_dir = store_dir
+        self._connection = None
+        self._lock = threading.Lock()
+
+    @property
+    def db(self):
+        if self._connection is None:
+            os.makedirs(self.store_dir, exist_ok=True)
+            connection = sqlite3.connect(os.path.join(self.store_dir, "manifest.sqlite3"), check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(self.MANIFEST_SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def manifest(self, message_id):
+        """
+        (stato del messaggio o None, parti gia' salvate per partId); le parti il cui blob non esiste piu'
+        vengono ignorate e quindi riscaricate
+        """
+        with self._lock:
+            state = self.db.execute(
+                "SELECT part_count FROM messages WHERE message_id = ?", (message_id,)
+            ).fetchone()
+            rows = self.db.execute(
+                """
+                SELECT part_id, attachment_id, filename, file_name, size, sha256 FROM parts
+                WHERE message_id = ? ORDER BY position
+                """,
+                (message_id,)
+            ).fetchall()
+        parts = {}
+        for part_id, attachment_id, filename, file_name, size, sha256 in rows:
+            if os.path.exists(self.blob_path(sha256)):
+                parts[part_id] = {
+                    "attachment_id": attachment_id, "filename": filename, "file_name": file_name,
+                    "size": size, "sha256": sha256
+                }
+        if state is not None:
+            state = {"part_count": state[0]}
+        return state, parts
+
+    def record_part(self, message_id, part_id, position, attachment_id, filename, file_name, size, sha256):
+        with self._lock, self.db:
+            self.db.execute(
+                """
+                INSERT OR REPLACE INTO parts
+                (message_id, part_id, position, attachment_id, filename, file_name, size, sha256)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (message_id, part_id, position, attachment_id, filename, file_name, size, sha256)
+            )
+
+    def record_message(self, message_id, part_count):
+        with self._lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO messages (message_id, part_count) VALUES (?, ?)",
+                (message_id, part_count)
+            )
+
+    def blob_path(self, sha256):
+        return os.path.join(self.store_dir, sha256[:2], sha256)
+
+    @contextlib.contextmanager
+    def new_blob(self):
+        """
+        BlobWriter su un file temporaneo; alla chiusura diventa il blob del suo hash (o viene scartato
+        se il blob esiste gia')
+        """
+        os.makedirs(self.store_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.store_dir, prefix=".", suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                writer = BlobWriter(f)
+                yield writer
+            writer.sha256 = writer._hash.hexdigest()
+            blob_path = self.blob_path(writer.sha256)
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            # os.link non sovrascrive: con download concorrenti dello stesso contenuto vince il primo
+            with contextlib.suppress(FileExistsError):
+                os.link(temp_path, blob_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def link(self, sha256, message_id, file_name):
+        """
+        Collega il blob in root/<message_id>/<file_name> e restituisce il percorso
+        """
+        directory = os.path.join(self.root, safe_file_name(message_id, "message"))
+        file_path = os.path.join(directory, file_name)
+        blob_path = self.blob_path(sha256)
+        if os.path.exists(file_path) and os.path.samefile(file_path, blob_path):
+            return file_path
+
+        os.makedirs(directory, exist_ok=True)
+        temp_path = os.path.join(directory, f".{file_name}.{secrets.token_hex(4)}.part")
+        try:
+            os.link(blob_path, temp_path)
+        except OSError:
+            # Filesystem senza hardlink: copia
+            shutil.copyfile(blob_path, temp_path)
+        os.replace(temp_path, file_path)
+        return file_path
+
+
+attachment_store = AttachmentStore(ATTACHMENT_DIR, ATTACHMENT_STORE_DIR)
+
+class MailboxMirror:
+    """
+    Copia locale (SQLite) dei metadati della casella.
+    Il primo sync legge tutta la casella, i successivi applicano solo le modifiche
+    restituite da users.history.list a partire dall'historyId salvato.
+    """
+
+    SCHEMA_VERSION = "4"
+    TABLES = ("messages", "message_labels", "labels", "attachments", "messages_fts", "pending_fetch", "full_sync_seen")
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            rowid INTEGER PRIMARY KEY,
+            id TEXT NOT NULL UNIQUE,
+            thread_id TEXT,
+            internal_date INTEGER,
+            subject TEXT,
+            sender TEXT,
+            snippet TEXT,
+            has_attachment INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS messages_internal_date ON messages (internal_date);
+        CREATE TABLE IF NOT EXISTS message_labels (
+            message_id TEXT NOT NULL,
+            label_id TEXT NOT NULL,
+            PRIMARY KEY (message_id, label_id)
+        );
+        CREATE INDEX IF NOT EXISTS message_labels_label ON message_labels (label_id);
+        CREATE TABLE IF NOT EXISTS labels (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS attachments (
+            message_id TEXT NOT NULL,
+            part_id TEXT NOT NULL,
+            attachment_id TEXT,
+            filename TEXT NOT NULL,
+            mime_type TEXT,
+            size INTEGER,
+            PRIMARY KEY (message_id, part_id)
+        );
+        CREATE TABLE IF NOT EXISTS pending_fetch (
+            message_id TEXT PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS full_sync_seen (
+            message_id TEXT PRIMARY KEY
+        );
+    """
+    # rowid dell'indice = rowid di messages
+    FTS_SCHEMA = "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(subject, sender, snippet)"
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self.fts_available = False
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+
+    @property
+    def db(self):
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)")
+            row = connection.execute("SELECT value FROM sync_state WHERE key = 'schema_version'").fetchone()
+            if not row or row[0] != self.SCHEMA_VERSION:
+                # Il mirror e' solo una cache: con uno schema diverso si riparte da un sync completo
+                with connection:
+                    for table in self.TABLES:
+                        connection.execute(f"DROP TABLE IF EXISTS {table}")
+                    connection.execute("DELETE FROM sync_state")
+                    connection.execute(
+                        "INSERT INTO sync_state (key, value) VALUES ('schema_version', ?)", (self.SCHEMA_VERSION,)
+                    )
+            connection.executescript(self.SCHEMA)
+            try:
+                connection.execute(self.FTS_SCHEMA)
+                self.fts_available = True
+            except sqlite3.OperationalError as e:
+                logger.warning(f"FTS5 non disponibile in SQLite, indice locale disattivato: {str(e)}")
+            self._connection = connection
+        return self._connection
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def get_state(self, key):
+        with self._lock:
+            row = self.db.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else None
+
+    def _set_state(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def _store_message(self, message):
+        header_values = {}
+        for header in message.get("payload", {}).get("headers", []):
+            header_values.setdefault(header["name"].lower(), header["value"])
+        attachments = attachment_parts(message)
+        subject = header_values.get("subject", "")
+        sender = header_values.get("from", "")
+        snippet = message.get("snippet", "")
+
+        self.db.execute(
+            """
+            INSERT INTO messages (id, thread_id, internal_date, subject, sender, snippet, has_attachment)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+                thread_id = excluded.thread_id, internal_date = excluded.internal_date, subject = excluded.subject,
+                sender = excluded.sender, snippet = excluded.snippet, has_attachment = excluded.has_attachment
+            """,
+            (
+                message["id"], message.get("threadId"), int(message.get("internalDate", 0)),
+                subject, sender, snippet, int(bool(attachments))
+            )
+        )
+        rowid = self.db.execute("SELECT rowid FROM messages WHERE id = ?", (message["id"],)).fetchone()[0]
+        if self.fts_available:
+            self.db.execute("DELETE FROM messages_fts WHERE rowid = ?", (rowid,))
+            self.db.execute(
+                "INSERT INTO messages_fts (rowid, subject, sender, snippet) VALUES (?, ?, ?, ?)",
+                (rowid, subject, sender, snippet)
+            )
+
+        self.db.execute("DELETE FROM attachments WHERE message_id = ?", (message["id"],))
+        self.db.executemany(
+            "INSERT OR REPLACE INTO attachments (message_id, part_id, attachment_id, filename, mime_type, size) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    message["id"], part.get("partId") or str(position), part["body"]["attachmentId"], part["filename"],
+                    part.get("mimeType"), part["body"].get("size")
+                )
+                for position, part in enumerate(attachments)
+            ]
+        )
+        self._set_labels(message["id"], message.get("labelIds", []))
+
+    def _set_labels(self, message_id, label_ids):
+        self.db.execute("DELETE FROM message_labels WHERE message_id = ?", (message_id,))
+        self.db.executemany(
+            "INSERT OR IGNORE INTO message_labels (message_id, label_id) VALUES (?, ?)",
+            [(message_id, label_id) for label_id in label_ids]
+        )
+
+    def add_label(self, message_ids, label):
+        """
+        Aggiunge una label ai messaggi gia' nel mirror dopo una modifica fatta da questa app, cosi' l'indice
+        la riflette subito invece che al prossimo sync (che la riporta comunque dalla history)
+        """
+        with self._lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO labels (id, name) VALUES (?, ?)", (label["id"], label["name"]))
+            self.db.executemany(
+                "INSERT OR IGNORE INTO message_labels (message_id, label_id) SELECT id, ? FROM messages WHERE id = ?",
+                [(label["id"], message_id) for message_id in message_ids]
+            )
+
+    def _delete_message(self, message_id):
+        row = self.db.execute("SELECT rowid FROM messages WHERE id = ?", (message_id,)).fetchone()
+        if row and self.fts_available:
+            self.db.execute("DELETE FROM messages_fts WHERE rowid = ?", (row[0],))
+        self.db.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+        self.db.execute("DELETE FROM message_labels WHERE message_id = ?", (message_id,))
+        self.db.execute("DELETE FROM attachments WHERE message_id = ?", (message_id,))
+        self.db.execute("DELETE FROM pending_fetch WHERE message_id = ?", (message_id,))
+
+    def _fetch_and_store(self, service, message_ids):
+        not_found = set()
+        fetched, errors = batch_get_messages(
+            service, message_ids, not_found=not_found, format="full", fields=MIRROR_FIELDS
+        )
+        with self._lock, self.db:
+            for message in fetched.values():
+                self._store_message(message)
+            # 404: messaggio eliminato dopo essere comparso nella history, non va riletto
+            self.db.executemany(
+                "DELETE FROM pending_fetch WHERE message_id = ?",
+                [(message_id,) for message_id in list(fetched) + list(not_found)]
+            )
+            # Altri errori (429, 5xx): l'historyId avanza comunque, quindi i messaggi vengono riletti al prossimo sync
+            self.db.executemany(
+                "INSERT OR IGNORE INTO pending_fetch (message_id) VALUES (?)",
+                [(message_id,) for message_id in errors if message_id not in not_found]
+            )
+        return len(fetched), errors
+
+    def _pending_fetch(self):
+        with self._lock:
+            return [row[0] for row in self.db.execute("SELECT message_id FROM pending_fetch")]
+
+    def _sync_labels(self, service):
+        labels = execute_request(service.users().labels().list(userId="me")).get("labels", [])
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM labels")
+            self.db.executemany(
+                "INSERT INTO labels (id, name) VALUES (?, ?)",
+                [(label["id"], label["name"]) for label in labels]
+            )
+
+    def _full_sync(self, service):
+        """
+        Legge tutta la casella salvando i progressi pagina per pagina: un sync interrotto riprende dalla pagina
+        successiva con lo stesso historyId iniziale, invece di ricominciare da capo
+        """
+        start_history_id = self.get_state("full_sync_history_id")
+        page_token = self.get_state("full_sync_page_token")
+        if start_history_id is None:
+            # L'historyId letto prima della scansione: le modifiche avvenute durante verranno riapplicate
+            start_history_id = execute_request(service.users().getProfile(userId="me"))["historyId"]
+            page_token = None
+            with self._lock, self.db:
+                self.db.execute("DELETE FROM full_sync_seen")
+                self._set_state("full_sync_history_id", start_history_id)
+
+        fetched = 0
+        while True:
+            try:
+                results = execute_request(service.users().messages().list(
+                    userId="me", maxResults=GMAIL_MAX_PAGE_SIZE, pageToken=page_token
+                ))
+            except HttpError as e:
+                # pageToken salvato non piu' valido: si riparte dalla prima pagina
+                if page_token is None or getattr(e.resp, "status", None) != 400:
+                    raise
+                logger.warning("Ripresa del sync completo non possibile, si riparte dalla prima pagina")
+                page_token = None
+                continue
+            message_ids = [message["id"] for message in results.get("messages", [])]
+            count, _ = self._fetch_and_store(service, message_ids)
+            fetched += count
+            page_token = results.get("nextPageToken")
+            with self._lock, self.db:
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO full_sync_seen (message_id) VALUES (?)",
+                    [(message_id,) for message_id in message_ids]
+                )
+                if page_token:
+                    self._set_state("full_sync_page_token", page_token)
+            if not page_token:
+                break
+
+        with self._lock, self.db:
+            stale = [
+                row[0] for row in self.db.execute(
+                    "SELECT id FROM messages WHERE id NOT IN (SELECT message_id FROM full_sync_seen)"
+                )
+            ]
+            for message_id in stale:
+                self._delete_message(message_id)
+            self.db.execute("DELETE FROM full_sync_seen")
+            self.db.execute("DELETE FROM sync_state WHERE key IN ('full_sync_history_id', 'full_sync_page_token')")
+            self._set_state("history_id", start_history_id)
+            self._set_state("synced_at", time.time())
+        query_cache.invalidate()
+
+        return {"mode": "full", "added": fetched, "deleted": len(stale), "relabeled": 0,
+                "pending": len(self._pending_fetch()), "history_id": start_history_id}
+
+    def _incremental_sync(self, service, history_id):
+        added = set()
+        deleted = set()
+        relabeled = {}
+        latest_history_id = history_id
+        page_token = None
+        while True:
+            results = execute_request(service.users().history().list(
+                userId="me", startHistoryId=history_id, pageToken=page_token, maxResults=GMAIL_MAX_PAGE_SIZE
+            ))
+            for record in results.get("history", []):
+                for item in record.get("messagesAdded", []):
+                    added.add(item["message"]["id"])
+                    deleted.discard(item["message"]["id"])
+                for item in record.get("messagesDeleted", []):
+                    deleted.add(item["message"]["id"])
+                    added.discard(item["message"]["id"])
+                for key in ("labelsAdded", "labelsRemoved"):
+                    for item in record.get(key, []):
+                        relabeled[item["message"]["id"]] = item["message"].get("labelIds", [])
+            latest_history_id = results.get("historyId", latest_history_id)
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                break
+
+        retried = set(self._pending_fetch()) - deleted
+        fetched, errors = self._fetch_and_store(service, sorted(added | retried))
+        with self._lock, self.db:
+            for message_id in deleted:
+                self._delete_message(message_id)
+            for message_id, label_ids in relabeled.items():
+                if message_id not in added and message_id not in deleted:
+                    self._set_labels(message_id, label_ids)
+            self._set_state("history_id", latest_history_id)
+            self._set_state("synced_at", time.time())
+
+        for message_id, label_ids in relabeled.items():
+            message_cache.update_labels(message_id, label_ids)
+        for message_id in deleted:
+            message_cache.discard(message_id)
+        if added or deleted or relabeled:
+            query_cache.invalidate()
+
+        return {"mode": "incremental", "added": fetched, "deleted": len(deleted), "relabeled": len(relabeled),
+                "pending": len(self._pending_fetch()), "history_id": latest_history_id}
+
+    def sync(self, service):
+        """
+        Porta il mirror allo stato attuale della casella; bloccante, da eseguire nel pool google_executor.
+        Se un'altra sincronizzazione e' gia' in corso restituisce subito {"mode": "in_progress"}, senza
+        occupare un thread del pool per tutta la sua durata (la prima sincronizzazione completa puo' durare ore)
+        """
+        if not self._sync_lock.acquire(blocking=False):
+            return {"mode": "in_progress"}
+        try:
+            self._sync_labels(service)
+            history_id = self.get_state("history_id")
+            if history_id is None:
+                return self._full_sync(service)
+            try:
+                return self._incremental_sync(service, history_id)
+            except HttpError as e:
+                # historyId troppo vecchio (Gmail conserva la history per circa una settimana)
+                if getattr(e.resp, "status", None) == 404:
+                    logger.warning("historyId scaduto, risincronizzazione completa della casella")
+                    return self._full_sync(service)
+                raise
+        finally:
+            self._sync_lock.release()
+
+    def is_fresh(self):
+        """
+        True se l'indice FTS e' utilizzabile e il mirror e' stato sincronizzato da meno di MAILBOX_INDEX_MAX_AGE secondi
+        """
+        try:
+            synced_at = self.get_state("synced_at")
+        except sqlite3.Error:
+            return False
+        return self.fts_available and synced_at is not None and time.time() - float(synced_at) <= MAILBOX_INDEX_MAX_AGE
+
+    @staticmethod
+    def _fts_phrase(text):
+        return '"' + text.replace('"', '""') + '"'
+
+    def search(self, filters, limit, offset=0):
+        """
+        Cerca nel mirror con gli stessi filtri di read_emails, dalla email piu' recente.
+        Restituisce (riepiloghi nel formato di summarize_message, True se ci sono altri risultati).
+        """
+        label_condition = """
+            EXISTS (
+                SELECT 1 FROM message_labels ml LEFT JOIN labels l ON l.id = ml.label_id
+                WHERE ml.message_id = m.id
+                AND (ml.label_id = ? COLLATE NOCASE OR replace(l.name, ' ', '-') = replace(?, ' ', '-') COLLATE NOCASE)
+            )
+        """
+        conditions = []
+        params = []
+        match = []
+
+        label = filters.get("label")
+        if label:
+            conditions.append(label_condition)
+            params += [label, label]
+        if filters.get("exclude_label"):
+            conditions.append("NOT " + label_condition)
+            params += [filters["exclude_label"], filters["exclude_label"]]
+        if filters.get("label_id"):
+            conditions.append("EXISTS (SELECT 1 FROM message_labels ml WHERE ml.message_id = m.id AND ml.label_id = ?)")
+            params.append(filters["label_id"])
+        if filters.get("exclude_label_id"):
+            conditions.append(
+                "NOT EXISTS (SELECT 1 FROM message_labels ml WHERE ml.message_id = m.id AND ml.label_id = ?)"
+            )
+            params.append(filters["exclude_label_id"])
+        # Come la ricerca Gmail: spam e cestino esclusi se non richiesti esplicitamente
+        requested = {(label or "").upper(), (filters.get("label_id") or "").upper()}
+        if not requested & {"SPAM", "TRASH"}:
+            conditions.append(
+                "NOT EXISTS (SELECT 1 FROM message_labels ml WHERE ml.message_id = m.id AND ml.label_id IN ('SPAM', 'TRASH'))"
+            )
+        if filters.get("has_attachment"):
+            conditions.append("m.has_attachment = 1")
+        if filters.get("sender"):
+            conditions.append("m.sender LIKE ? ESCAPE '\\'")
+            escaped = filters["sender"].replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params.append(f"%{escaped}%")
+        if filters.get("subject"):
+            match.append("subject : " + self._fts_phrase(filters["subject"]))
+        if filters.get("exact_subject"):
+            match.append("subject : " + self._fts_phrase(filters["exact_subject"]))
+        if filters.get("text"):
+            match.append(self._fts_phrase(filters["text"]))
+        if match:
+            conditions.append("m.rowid IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)")
+            params.append(" AND ".join(match))
+
+        sql = (
+            "SELECT m.id, m.snippet, m.subject, m.sender FROM messages m WHERE "
+            + " AND ".join(conditions)
+            + " ORDER BY m.internal_date DESC, m.rowid DESC LIMIT ? OFFSET ?"
+        )
+        with self._lock:
+            rows = self.db.execute(sql, params + [limit + 1, offset]).fetchall()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            labels = {}
+            if rows:
+                placeholders = ",".join("?" for _ in rows)
+                for message_id, label_id in self.db.execute(
+                    f"SELECT message_id, label_id FROM message_labels WHERE message_id IN ({placeholders})",
+                    [row[0] for row in rows]
+                ):
+                    labels.setdefault(message_id, []).append(label_id)
+
+        emails = [
+            {
+                "id": message_id,
+                "snippet": snippet,
+                "subject": subject or "No Subject",
+                "from": sender or "Unknown Sender",
+                "labels": labels.get(message_id, [])
+            }
+            for message_id, snippet, subject, sender in rows
+        ]
+        return emails, has_more
+
+    def pending_attachment_downloads(self, limit):
+        """
+        Email con allegati senza label 'Downloaded' (escluse spam e cestino), dalla piu' recente
+        """
+        with self._lock:
+            rows = self.db.execute(
+                """
+                SELECT m.id FROM messages m
+                WHERE m.has_attachment = 1
+                AND NOT EXISTS (
+                    SELECT 1 FROM message_labels ml
+                    WHERE ml.message_id = m.id
+                    AND (ml.label_id IN ('SPAM', 'TRASH')
+                         OR ml.label_id IN (SELECT id FROM labels WHERE name = 'Downloaded'))
+                )
+                ORDER BY m.internal_date DESC
+                LIMIT ?
+                """,
+                (limit,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+
+mailbox_mirror = MailboxMirror(MAILBOX_DB)
+
 def verify_api_key(x_api_key: Annotated[str | None, Header()] = None):
     """
     Verify API key from X-API-Key header
@@ -111,28 +2081,22 @@ async def health_token(auth: bool = Depends(verify_api_key)):
                 detail=f"token_invalid_format: campi mancanti nel token: {', '.join(missing_fields)}"
             )
 
-        creds = google.oauth2.credentials.Credentials(
-            token=creds_dict["token"],
-            refresh_token=creds_dict["refresh_token"],
-            token_uri=creds_dict["token_uri"],
-            client_id=creds_dict["client_id"],
-            client_secret=creds_dict["client_secret"],
-            scopes=creds_dict["scopes"]
-        )
-
-        service = build("gmail", "v1", credentials=creds)
-        profile = service.users().getProfile(userId="me").execute()
+        service = await google_service("gmail", "v1")
+        profile = await google_execute(service.users().getProfile(userId="me"))
 
         return {
             "ok": True,
             "status": "token_valid",
             "email": profile.get("emailAddress"),
             "messages_total": profile.get("messagesTotal"),
-            "threads_total": profile.get("threadsTotal")
+            "threads_total": profile.get("threadsTotal"),
+            "expires_in_seconds": google_services.token_status()["expires_in_seconds"]
         }
 
     except HTTPException:
         raise
+    except google.auth.exceptions.RefreshError as e:
+        raise HTTPException(status_code=401, detail=f"token_invalid_or_revoked: {str(e)}")
     except HttpError as e:
         status = getattr(getattr(e, "resp", None), "status", None)
         if status in (401, 403):
@@ -147,6 +2111,20 @@ async def health_token(auth: bool = Depends(verify_api_key)):
         raise HTTPException(status_code=500, detail=f"token_check_failed: {str(e)}")
 
 
+@app.get("/health/token-expiry")
+async def health_token_expiry(auth: bool = Depends(verify_api_key)):
+    """
+    Tempo alla scadenza del token in memoria, senza chiamate a Google (per il monitoraggio)
+    """
+    return google_services.token_status()
+
+
+@app.get("/health/cache")
+async def health_cache(auth: bool = Depends(verify_api_key)):
+    return {"messages": message_cache.stats(), "queries": query_cache.stats(), "coalescing": google_inflight.stats(),
+            "labels": label_directory.stats()}
+
+
 @app.get("/authenticate")
 async def authenticate():
     temp_credentials_file = os.path.join(TEMP_DIR, "temp_credentials.json")
@@ -210,18 +2188,9 @@ async def oauth2callback(request: Request):
         print(f"Code ricevuto: {code[:10]}...")  # Stampa solo i primi 10 caratteri per sicurezza
         flow.fetch_token(code=code)
 
-        credentials = flow.credentials
-        credentials_dict = {
-            "token": credentials.token,
-            "refresh_token": credentials.refresh_token,
-            "token_uri": credentials.token_uri,
-            "client_id": credentials.client_id,
-            "client_secret": credentials.client_secret,
-            "scopes": credentials.scopes,
-        }
-
-        with open(TOKEN_FILE, "w") as token_file:
-            json.dump(credentials_dict, token_file)
+        with token_file_lock():
+            write_token_file(credentials_to_dict(flow.credentials))
+        google_services.invalidate()
 
         return {"message": f"Autenticazione completata con successo, token salvato in {TOKEN_FILE}"}
 
@@ -245,63 +2214,79 @@ async def read_emails(
     HasAttachment: bool = Query(False, description="Filter emails with attachments"),
     From: str = Query(None, description="Filter emails from a specific sender"),
     Text: str = Query(None, description="Filter emails containing this text in the body"),
-    max_results: int = Query(10, description="Maximum number of emails to return (default 10)")
+    max_results: int = Query(10, description="Maximum number of emails to return (default 10)"),
+    headers: str = Query(None, description="Additional headers to return, comma separated (e.g. Date,To,Message-ID)"),
+    cursor: str = Query(None, description="Opaque cursor from a previous response's next_cursor"),
+    stream: bool = Query(False, description="Stream results as newline-delimited JSON (max_results may span several pages)"),
+    source: str = Query(
+        "auto",
+        description="auto (local index when fresh, otherwise Gmail; Text and headers always use Gmail), "
+                    "index (Text matches subject, sender and snippet only) or gmail"
+    ),
+    LabelId: str = Query(None, description="Filter emails by label id (e.g. Label_123 or INBOX)"),
+    ExcludeLabelId: str = Query(None, description="Exclude emails with this label id")
 ):
     try:
         if not os.path.exists(TOKEN_FILE):
             raise HTTPException(status_code=401, detail="Token non trovato. Autenticati tramite /authenticate.")
+        if source not in ("auto", "index", "gmail"):
+            raise HTTPException(status_code=400, detail="source deve essere auto, index o gmail.")
 
-        with open(TOKEN_FILE, "r") as token:
-            creds_dict = json.load(token)
+        service = await google_service("gmail", "v1")
 
-        creds = google.oauth2.credentials.Credentials(
-            token=creds_dict["token"],
-            refresh_token=creds_dict["refresh_token"],
-            token_uri=creds_dict["token_uri"],
-            client_id=creds_dict["client_id"],
-            client_secret=creds_dict["client_secret"],
-            scopes=creds_dict["scopes"]
+        filters = email_filters(
+            Label, ExcludeLabel, Subject, ExactSubject, HasAttachment, From, Text, LabelId, ExcludeLabelId
         )
+        query = filters_scope(filters)
+        page_token, cursor_source = decode_cursor(cursor, query)
+        extra_headers = parse_header_names(headers)
+
+        # L'indice locale non conserva header aggiuntivi ne' il corpo delle email (Text cerca solo in oggetto,
+        # mittente e snippet): in auto quei casi vanno a Gmail. Un cursore dell'indice resta sull'indice.
+        if cursor_source:
+            use_index = cursor_source == "index"
+        elif source == "gmail" or extra_headers or (source == "auto" and Text) or not (MAILBOX_SYNC and MAILBOX_INDEX):
+            use_index = False
+        else:
+            use_index = await run_google(mailbox_mirror.is_fresh)
+        if source == "index" and not use_index:
+            raise HTTPException(status_code=503, detail="Indice locale non disponibile o non aggiornato.")
+
+        if use_index:
+            offset = int(page_token or 0)
+            if stream:
+                return StreamingResponse(
+                    stream_index_summaries(filters, query, offset, max_results),
+                    media_type=NDJSON_MEDIA_TYPE
+                )
+            page_size = max(1, min(max_results, GMAIL_MAX_PAGE_SIZE))
+            emails, has_more = await run_google(mailbox_mirror.search, filters, page_size, offset)
+            next_offset = str(offset + len(emails)) if has_more else None
+            return {"emails": emails, "next_cursor": encode_cursor(query, next_offset, "index"), "source": "index"}
+
+        if stream:
+            return StreamingResponse(
+                stream_email_summaries(service, filters, query, page_token, max_results, extra_headers),
+                media_type=NDJSON_MEDIA_TYPE
+            )
+
+        page_size = max(1, min(max_results, GMAIL_MAX_PAGE_SIZE))
 
-        service = build("gmail", "v1", credentials=creds)
-
-        query_string = ""
-        if Label:
-            query_string += f"label:{Label} "
-        if ExcludeLabel:
-            query_string += f"-label:{ExcludeLabel} "
-        if Subject:
-            query_string += f"subject:{Subject} "
-        if ExactSubject:
-            query_string += f'subject:"{ExactSubject}" '
-        if HasAttachment:
-            query_string += "has:attachment "
-        if From:
-            query_string += f"from:{From} "
-        if Text:
-            query_string += f'"{Text}" '
-
-        results = service.users().messages().list(userId="me", maxResults=max_results, q=query_string.strip()).execute()
+        results = await search_messages(service, filters, page_size, page_token)
         messages = results.get("messages", [])
-        emails = []
-
-        for message in messages:
-            msg = service.users().messages().get(userId="me", id=message["id"]).execute()
-            payload = msg.get("payload", {})
-            headers = payload.get("headers", [])
-            subject = next((header["value"] for header in headers if header["name"] == "Subject"), "No Subject")
-            sender = next((header["value"] for header in headers if header["name"] == "From"), "Unknown Sender")
-            labels = msg.get("labelIds", [])
-
-            emails.append({
-                "id": msg["id"],
-                "snippet": msg["snippet"],
-                "subject": subject,
-                "from": sender,
-                "labels": labels
-            })
+        summaries, errors = await get_message_summaries(
+            service, [message["id"] for message in messages], extra_headers
+        )
+        emails = [summaries[message["id"]] for message in messages if message["id"] in summaries]
 
-        return {"emails": emails}
+        response = {
+            "emails": emails,
+            "next_cursor": encode_cursor(query, results.get("nextPageToken")),
+            "source": "gmail"
+        }
+        if errors:
+            response["errors"] = [{"id": message_id, "error": error} for message_id, error in errors.items()]
+        return response
 
     except HTTPException:
         raise
@@ -322,64 +2307,27 @@ async def write_and_send_email(
         if not os.path.exists(TOKEN_FILE):
             raise HTTPException(status_code=401, detail="Token non trovato. Autenticati tramite /authenticate.")
 
-        with open(TOKEN_FILE, "r") as token:
-            creds_dict = json.load(token)
-
-        creds = google.oauth2.credentials.Credentials(
-            token=creds_dict["token"],
-            refresh_token=creds_dict["refresh_token"],
-            token_uri=creds_dict["token_uri"],
-            client_id=creds_dict["client_id"],
-            client_secret=creds_dict["client_secret"],
-            scopes=creds_dict["scopes"]
-        )
-
-        service = build("gmail", "v1", credentials=creds)
-
-        # Create message
-        if email_request.attachment_paths and len(email_request.attachment_paths) > 0:
-            message = MIMEMultipart()
-            message.attach(MIMEText(email_request.body, 'plain'))
-        else:
-            message = MIMEText(email_request.body, 'plain')
-
-        message['to'] = email_request.to
-        message['subject'] = email_request.subject
-        if email_request.cc:
-            message['cc'] = email_request.cc
-        if email_request.bcc:
-            message['bcc'] = email_request.bcc
-        message['from'] = "me"
-
-        # Add attachments
+        # Open attachments; the MIME message is streamed from them
         attached_files = []
-        if email_request.attachment_paths:
-            for filepath in email_request.attachment_paths:
+        with contextlib.ExitStack() as stack:
+            attachments = []
+            for filepath in email_request.attachment_paths or []:
                 filepath = filepath.strip()
                 if os.path.exists(filepath):
                     try:
-                        with open(filepath, "rb") as attachment:
-                            part = MIMEBase("application", "octet-stream")
-                            part.set_payload(attachment.read())
-                        encoders.encode_base64(part)
                         filename = os.path.basename(filepath)
-                        part.add_header(
-                            "Content-Disposition",
-                            f"attachment; filename={filename}",
-                        )
-                        message.attach(part)
+                        attachments.append((filename, stack.enter_context(open(filepath, "rb"))))
                         attached_files.append(filename)
                     except Exception as e:
                         logger.warning(f"Errore nell'allegare il file {filepath}: {str(e)}")
                 else:
                     logger.warning(f"File non trovato: {filepath}")
 
-        # Encode and send message
-        raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-        body = {'raw': raw_message}
-
-        # Send message
-        sent_message = service.users().messages().send(userId="me", body=body).execute()
+            # Send message
+            sent_message = await send_mime_message(
+                email_request.to, email_request.subject, email_request.body,
+                email_request.cc, email_request.bcc, attachments
+            )
 
         return {
             "success": True,
@@ -419,63 +2367,14 @@ async def write_and_send_email_with_uploads(
         if not os.path.exists(TOKEN_FILE):
             raise HTTPException(status_code=401, detail="Token non trovato. Autenticati tramite /authenticate.")
 
-        with open(TOKEN_FILE, "r") as token:
-            creds_dict = json.load(token)
-
-        creds = google.oauth2.credentials.Credentials(
-            token=creds_dict["token"],
-            refresh_token=creds_dict["refresh_token"],
-            token_uri=creds_dict["token_uri"],
-            client_id=creds_dict["client_id"],
-            client_secret=creds_dict["client_secret"],
-            scopes=creds_dict["scopes"]
-        )
-
-        service = build("gmail", "v1", credentials=creds)
-
-        # Create message
-        if files and len(files) > 0:
-            message = MIMEMultipart()
-            message.attach(MIMEText(body, 'plain'))
-        else:
-            message = MIMEText(body, 'plain')
-
-        message['to'] = to
-        message['subject'] = subject
-        if cc:
-            message['cc'] = cc
-        if bcc:
-            message['bcc'] = bcc
-        message['from'] = "me"
-
-        # Add uploaded files as attachments
-        attached_files = []
-        if files:
-            for file in files:
-                if file.filename:
-                    try:
-                        # Read file content
-                        file_content = await file.read()
-
-                        # Create attachment
-                        part = MIMEBase("application", "octet-stream")
-                        part.set_payload(file_content)
-                        encoders.encode_base64(part)
-                        part.add_header(
-                            "Content-Disposition",
-                            f"attachment; filename={file.filename}",
-                        )
-                        message.attach(part)
-                        attached_files.append(file.filename)
-                    except Exception as e:
-                        logger.warning(f"Errore nell'allegare il file {file.filename}: {str(e)}")
-
-        # Encode and send message
-        raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-        email_body = {'raw': raw_message}
+        # Uploaded files are already spooled by Starlette: the MIME message is streamed from them
+        uploads = [file for file in files or [] if file.filename]
+        attached_files = [file.filename for file in uploads]
 
         # Send message
-        sent_message = service.users().messages().send(userId="me", body=email_body).execute()
+        sent_message = await send_mime_message(
+            to, subject, body, cc, bcc, [(file.filename, file.file) for file in uploads]
+        )
 
         return {
             "success": True,
@@ -497,6 +2396,160 @@ async def write_and_send_email_with_uploads(
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Errore durante l'invio dell'email: {str(e)}")
 
+def write_base64_lines(source, f):
+    """
+    Copia source in f codificato in base64 a righe di 76 caratteri, MIME_READ_SIZE byte alla volta
+    """
+    pending = b""
+    while True:
+        chunk = source.read(MIME_READ_SIZE)
+        if not chunk:
+            break
+        data = pending + chunk
+        usable = len(data) - len(data) % 57
+        pending = data[usable:]
+        if usable:
+            f.write(base64.encodebytes(data[:usable]))
+    if pending:
+        f.write(base64.encodebytes(pending))
+
+def write_mime_message(f, to, subject, body, cc, bcc, attachments):
+    """
+    Scrive in f il messaggio MIME. Gli allegati, coppie (nome, file binario aperto), vengono codificati
+    a blocchi direttamente da disco: in memoria resta solo un buffer di MIME_READ_SIZE byte.
+    """
+    if attachments:
+        boundary = f"==============={secrets.token_hex(16)}=="
+        message = MIMEMultipart(boundary=boundary)
+        message.attach(MIMEText(body, 'plain'))
+    else:
+        message = MIMEText(body, 'plain')
+
+    message['to'] = to
+    message['subject'] = subject
+    if cc:
+        message['cc'] = cc
+    if bcc:
+        message['bcc'] = bcc
+    message['from'] = "me"
+
+    if not attachments:
+        f.write(message.as_bytes())
+        return
+
+    # Intestazioni e testo generati da email; le parti degli allegati vengono aggiunte prima del delimitatore finale
+    closing = f"--{boundary}--\n".encode()
+    head = message.as_bytes()
+    f.write(head[:head.rindex(closing)])
+    for filename, source in attachments:
+        part = MIMEBase("application", "octet-stream")
+        part["Content-Transfer-Encoding"] = "base64"
+        part.add_header("Content-Disposition", "attachment", filename=filename)
+        part.set_payload("")
+        f.write(f"--{boundary}\n".encode())
+        f.write(part.as_bytes())
+        write_base64_lines(source, f)
+        f.write(b"\n")
+    f.write(closing)
+
+async def send_mime_message(to, subject, body, cc, bcc, attachments):
+    """
+    Invia il messaggio con l'upload media di Gmail (message/rfc822): il MIME viene scritto in un file
+    temporaneo e caricato a blocchi, invece di passare da una stringa base64 nel corpo JSON.
+    Oltre RESUMABLE_UPLOAD_THRESHOLD byte l'upload e' ripristinabile.
+    """
+    with tempfile.TemporaryFile(dir=TEMP_DIR) as f:
+        await run_google(write_mime_message, f, to, subject, body, cc, bcc, attachments)
+        size = await run_google(f.tell)
+        if size > RESUMABLE_UPLOAD_THRESHOLD:
+            sent_message = await google_http.upload_resumable(
+                f"{GMAIL_UPLOAD_URL}/messages/send", f, size, "message/rfc822"
+            )
+        else:
+            sent_message = await google_http.upload(
+                f"{GMAIL_UPLOAD_URL}/messages/send", f, size, "message/rfc822", params={"uploadType": "media"}
+            )
+    query_cache.invalidate()
+    return sent_message
+
+def attachment_result(entry, file_path):
+    return {
+        "filename": entry["filename"],
+        "file_path": file_path,
+        "size": entry["size"],
+        "sha256": entry["sha256"]
+    }
+
+async def save_message_attachments(service, message_id, semaphore=None):
+    """
+    Salva nello store gli allegati di un messaggio, saltando quelli gia' nel manifest: un download interrotto
+    riprende dalle parti mancanti e un messaggio completo richiede solo la label.
+    Restituisce {"attachments", "resumed" (parti gia' presenti), "needs_label"}; la label si riassegna anche ai
+    messaggi gia' scaricati, perche' su Gmail puo' essere stata tolta (batchModify e' idempotente).
+    Le parti sono identificate dal partId, perche' Gmail cambia l'attachmentId a ogni lettura del messaggio.
+    """
+    state, done_parts = await run_google(attachment_store.manifest, message_id)
+    if state is not None and len(done_parts) == state["part_count"]:
+        attachments = []
+        for entry in done_parts.values():
+            file_path = await run_google(attachment_store.link, entry["sha256"], message_id, entry["file_name"])
+            attachments.append(attachment_result(entry, file_path))
+        return {"attachments": attachments, "resumed": len(attachments), "needs_label": bool(attachments)}
+
+    # Allegati scaricati in parallelo, al massimo ATTACHMENT_FETCH_CONCURRENCY alla volta
+    semaphore = semaphore or asyncio.Semaphore(ATTACHMENT_FETCH_CONCURRENCY)
+
+    async def save_attachment(position, part, file_name):
+        part_id = part.get("partId") or str(position)
+        entry = done_parts.get(part_id)
+        resumed = entry is not None
+        if entry is None:
+            async with semaphore:
+                with attachment_store.new_blob() as blob:
+                    await download_attachment(service, message_id, part["body"]["attachmentId"], blob)
+            entry = {
+                "attachment_id": part["body"]["attachmentId"], "filename": part["filename"],
+                "file_name": file_name, "size": blob.size, "sha256": blob.sha256
+            }
+            await run_google(attachment_store.record_part, message_id, part_id, position, **entry)
+        file_path = await run_google(attachment_store.link, entry["sha256"], message_id, entry["file_name"])
+        return attachment_result(entry, file_path), resumed
+
+    message = await google_execute(service.users().messages().get(userId="me", id=message_id, fields=ATTACHMENT_FIELDS))
+    parts = attachment_parts(message)
+    # Si attende anche la fine delle parti riuscite, cosi' restano nel manifest se un'altra fallisce
+    results = await asyncio.gather(*(
+        save_attachment(position, part, file_name)
+        for position, (part, file_name) in enumerate(zip(parts, attachment_file_names(parts)))
+    ), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    await run_google(attachment_store.record_message, message_id, len(results))
+    return {
+        "attachments": [attachment for attachment, _ in results],
+        "resumed": sum(1 for _, resumed in results if resumed),
+        "needs_label": bool(results)
+    }
+
+async def mark_downloaded(service, message_ids):
+    """
+    Assegna la label 'Downloaded' alle email (un batchModify ogni GMAIL_BATCH_MODIFY_SIZE) e la riporta nel mirror locale
+    """
+    downloaded_label = await label_directory.get_or_create(service, DOWNLOADED_LABEL)
+    message_ids = list(message_ids)
+    for start in range(0, len(message_ids), GMAIL_BATCH_MODIFY_SIZE):
+        await google_execute(service.users().messages().batchModify(
+            userId="me",
+            body={"ids": message_ids[start:start + GMAIL_BATCH_MODIFY_SIZE], "addLabelIds": [downloaded_label["id"]]}
+        ))
+    # batchModify non restituisce le label aggiornate: i riepiloghi in cache vengono riletti
+    for message_id in message_ids:
+        message_cache.discard(message_id)
+    query_cache.invalidate()
+    if MAILBOX_SYNC:
+        await run_google(mailbox_mirror.add_label, message_ids, downloaded_label)
+
 @app.get("/gmail/download-attachments/{message_id}")
 async def download_attachments(
     message_id: str,
@@ -506,70 +2559,407 @@ async def download_attachments(
         if not os.path.exists(TOKEN_FILE):
             raise HTTPException(status_code=401, detail="Token non trovato. Autenticati tramite /authenticate.")
 
-        with open(TOKEN_FILE, "r") as token:
-            creds_dict = json.load(token)
+        service = await google_service("gmail", "v1")
 
-        creds = google.oauth2.credentials.Credentials(
-            token=creds_dict["token"],
-            refresh_token=creds_dict["refresh_token"],
-            token_uri=creds_dict["token_uri"],
-            client_id=creds_dict["client_id"],
-            client_secret=creds_dict["client_secret"],
-            scopes=creds_dict["scopes"]
+        result = await save_message_attachments(service, message_id)
+        attachments = result["attachments"]
+        if result["needs_label"]:
+            await mark_downloaded(service, [message_id])
+
+        return {
+            "attachments": attachments,
+            "resumed": result["resumed"],
+            "message": f"Allegati scaricati e label 'Downloaded' assegnata all'email." if attachments else "Nessun allegato trovato."
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Errore durante il download degli allegati: {str(e)}")
+
+
+def parse_byte_range(range_header, size):
+    """
+    (inizio, fine) inclusivi per un header Range con un solo intervallo in byte; None se assente
+    o non gestito (si risponde con il file intero). Intervalli non soddisfacibili: 416.
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start_text, _, end_text = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if start_text:
+            start = int(start_text)
+            end = min(int(end_text), size - 1) if end_text else size - 1
+        else:
+            start = max(size - int(end_text), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start > end:
+        raise HTTPException(
+            status_code=416, detail="Intervallo non valido.", headers={"Content-Range": f"bytes */{size}"}
         )
+    return start, end
+
+def iter_file_range(file_path, start, end):
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(ATTACHMENT_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def content_disposition(filename):
+    return f"attachment; filename*=utf-8''{urllib.parse.quote(filename)}"
+
+async def find_attachment_part(service, message_id, part_id):
+    message = await google_execute(service.users().messages().get(userId="me", id=message_id, fields=ATTACHMENT_FIELDS))
+    parts = attachment_parts(message)
+    for position, part in enumerate(parts):
+        if (part.get("partId") or str(position)) == part_id:
+            return part
+    return None
+
+class ZipStreamBuffer:
+    """
+    Destinazione non seekable per zipfile: i byte scritti vengono consegnati con drain() man mano,
+    quindi l'archivio non e' mai tutto in memoria (zipfile usa i data descriptor al posto del seek)
+    """
 
-        service = build("gmail", "v1", credentials=creds)
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
 
-        def extract_attachments(parts, message_id, service):
-            extracted = []
-            for part in parts:
-                if part.get("parts"):
-                    extracted.extend(extract_attachments(part.get("parts", []), message_id, service))
-                else:
-                    if part.get("filename") and part.get("body", {}).get("attachmentId"):
-                        attachment_id = part["body"]["attachmentId"]
-                        attachment = service.users().messages().attachments().get(
-                            userId="me", messageId=message_id, id=attachment_id
-                        ).execute()
-                        file_data = base64.urlsafe_b64decode(attachment["data"].encode("UTF-8"))
-
-                        os.makedirs(ATTACHMENT_DIR, exist_ok=True)
-
-                        file_path = os.path.join(ATTACHMENT_DIR, part["filename"])
-                        with open(file_path, "wb") as f:
-                            f.write(file_data)
-                        extracted.append({
-                            "filename": part["filename"],
-                            "file_path": file_path
-                        })
-            return extracted
-
-        message = service.users().messages().get(userId="me", id=message_id).execute()
-        parts = message.get("payload", {}).get("parts", [])
-        attachments = extract_attachments(parts, message_id, service)
-
-        labels = service.users().labels().list(userId="me").execute().get("labels", [])
-        downloaded_label = next((label for label in labels if label["name"] == "Downloaded"), None)
-
-        if not downloaded_label:
-            new_label = {
-                "name": "Downloaded",
-                "labelListVisibility": "labelShow",
-                "messageListVisibility": "show"
-            }
-            downloaded_label = service.users().labels().create(userId="me", body=new_label).execute()
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
 
-        if attachments:
-            service.users().messages().modify(
-                userId="me",
-                id=message_id,
-                body={"addLabelIds": [downloaded_label["id"]]}
-            ).execute()
+    def tell(self):
+        return self._position
 
-        return {
-            "attachments": attachments,
-            "message": f"Allegati scaricati e label 'Downloaded' assegnata all'email." if attachments else "Nessun allegato trovato."
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def iter_blob(file_path, size):
+    return iterate_in_pool(iter_file_range(file_path, 0, size - 1))
+
+async def attachment_sources(service, message_id):
+    """
+    (nome, generatore dei byte) per ogni allegato di un messaggio: dallo store locale se gia' scaricato,
+    altrimenti da Gmail
+    """
+    state, stored = await run_google(attachment_store.manifest, message_id)
+    if state is not None and len(stored) == state["part_count"]:
+        return [
+            (entry["file_name"], lambda entry=entry: iter_blob(attachment_store.blob_path(entry["sha256"]), entry["size"]))
+            for entry in stored.values()
+        ]
+
+    message = await google_execute(service.users().messages().get(userId="me", id=message_id, fields=ATTACHMENT_FIELDS))
+    parts = attachment_parts(message)
+    sources = []
+    for position, (part, file_name) in enumerate(zip(parts, attachment_file_names(parts))):
+        entry = stored.get(part.get("partId") or str(position))
+        if entry is not None:
+            source = lambda entry=entry: iter_blob(attachment_store.blob_path(entry["sha256"]), entry["size"])
+        else:
+            source = lambda part=part: iter_attachment_data(service, message_id, part["body"]["attachmentId"])
+        sources.append((file_name, source))
+    return sources
+
+async def stream_attachments_zip(service, message_ids, compression):
+    """
+    Genera un archivio ZIP con gli allegati delle email (<message_id>/<nome>), costruito mentre gli allegati
+    arrivano. Gli errori finiscono in errors.txt all'interno dell'archivio.
+    """
+    buffer = ZipStreamBuffer()
+    archive = zipfile.ZipFile(buffer, "w", compression=compression)
+    errors = []
+    for message_id in message_ids:
+        try:
+            sources = await attachment_sources(service, message_id)
+        except Exception as e:
+            errors.append(f"{message_id}: {str(e)}")
+            continue
+
+        for file_name, source in sources:
+            info = zipfile.ZipInfo(f"{message_id}/{file_name}", date_time=time.localtime()[:6])
+            info.compress_type = compression
+            entry = archive.open(info, "w")
+            try:
+                async for chunk in source():
+                    # La compressione e' bloccante: fuori dall'event loop
+                    await run_google(entry.write, chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            except Exception as e:
+                errors.append(f"{message_id}/{file_name}: incompleto, {str(e)}")
+            finally:
+                entry.close()
+            yield buffer.drain()
+
+    if errors:
+        archive.writestr("errors.txt", "\n".join(errors) + "\n")
+    archive.close()
+    yield buffer.drain()
+
+@app.get("/gmail/attachments-zip")
+async def download_attachments_zip(
+    message_id: str = Query(None, description="Single message id; otherwise the read-emails filters are used"),
+    Label: str = Query(None, description="Filter emails by label"),
+    ExcludeLabel: str = Query(None, description="Exclude emails with this label"),
+    Subject: str = Query(None, description="Filter emails by subject"),
+    ExactSubject: str = Query(None, description="Filter emails by exact subject"),
+    From: str = Query(None, description="Filter emails by sender"),
+    Text: str = Query(None, description="Search text in the email body"),
+    LabelId: str = Query(None, description="Filter emails by label id"),
+    ExcludeLabelId: str = Query(None, description="Exclude emails with this label id"),
+    max_messages: int = Query(50, description="Maximum number of emails matching the filters (max 500)"),
+    compression: str = Query("deflate", description="deflate or stored"),
+    auth: bool = Depends(verify_api_key)
+):
+    """
+    Archivio ZIP in streaming con gli allegati di un'email o di tutte le email che soddisfano i filtri,
+    senza passare da ATTACHMENT_DIR
+    """
+    try:
+        if not os.path.exists(TOKEN_FILE):
+            raise HTTPException(status_code=401, detail="Token non trovato. Autenticati tramite /authenticate.")
+        if compression not in ("deflate", "stored"):
+            raise HTTPException(status_code=400, detail="compression deve essere deflate o stored.")
+
+        service = await google_service("gmail", "v1")
+        if message_id:
+            message_ids = [message_id]
+        else:
+            filters = email_filters(Label, ExcludeLabel, Subject, ExactSubject, True, From, Text, LabelId, ExcludeLabelId)
+            message_ids = await collect_message_ids(
+                service, filters, max(1, min(max_messages, BULK_DOWNLOAD_MAX_MESSAGES))
+            )
+
+        file_name = f"attachments-{message_id}.zip" if message_id else "attachments.zip"
+        return StreamingResponse(
+            stream_attachments_zip(
+                service, message_ids, zipfile.ZIP_DEFLATED if compression == "deflate" else zipfile.ZIP_STORED
+            ),
+            media_type="application/zip",
+            headers={"Content-Disposition": content_disposition(file_name)}
+        )
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Errore durante la creazione dell'archivio: {str(e)}")
+
+@app.get("/gmail/attachments/{message_id}")
+async def list_attachments(
+    message_id: str,
+    auth: bool = Depends(verify_api_key)
+):
+    """
+    Allegati di un messaggio, con il part_id da usare in /gmail/attachments/{message_id}/{part_id}
+    """
+    try:
+        if not os.path.exists(TOKEN_FILE):
+            raise HTTPException(status_code=401, detail="Token non trovato. Autenticati tramite /authenticate.")
+
+        service = await google_service("gmail", "v1")
+        message = await google_execute(service.users().messages().get(userId="me", id=message_id, fields=ATTACHMENT_FIELDS))
+        _, stored = await run_google(attachment_store.manifest, message_id)
+        parts = attachment_parts(message)
+        attachments = []
+        for position, part in enumerate(parts):
+            part_id = part.get("partId") or str(position)
+            attachments.append({
+                "part_id": part_id,
+                "filename": part["filename"],
+                "mime_type": part.get("mimeType"),
+                "size": part.get("body", {}).get("size"),
+                "stored": part_id in stored
+            })
+        return {"attachments": attachments}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Errore durante la lettura degli allegati: {str(e)}")
+
+@app.get("/gmail/attachments/{message_id}/{part_id}")
+async def get_attachment(
+    message_id: str,
+    part_id: str,
+    source: str = Query("auto", description="auto (local store when downloaded, otherwise Gmail), store or gmail"),
+    range_header: Annotated[str | None, Header(alias="Range")] = None,
+    auth: bool = Depends(verify_api_key)
+):
+    """
+    Contenuto di un allegato: dallo store locale (FileResponse, con supporto Range) se gia' scaricato,
+    altrimenti in streaming da Gmail senza salvarlo su disco
+    """
+    try:
+        if source not in ("auto", "store", "gmail"):
+            raise HTTPException(status_code=400, detail="source deve essere auto, store o gmail.")
+
+        if source != "gmail":
+            _, stored = await run_google(attachment_store.manifest, message_id)
+            entry = stored.get(part_id)
+            if entry is not None:
+                blob_path = attachment_store.blob_path(entry["sha256"])
+                media_type = mimetypes.guess_type(entry["filename"])[0] or "application/octet-stream"
+                headers = {
+                    "Accept-Ranges": "bytes",
+                    "ETag": '"' + entry["sha256"] + '"',
+                    "Content-Disposition": content_disposition(entry["filename"])
+                }
+                byte_range = parse_byte_range(range_header, entry["size"])
+                if byte_range is None:
+                    return FileResponse(blob_path, media_type=media_type, headers=headers)
+                start, end = byte_range
+                headers["Content-Range"] = f"bytes {start}-{end}/{entry['size']}"
+                headers["Content-Length"] = str(end - start + 1)
+                return StreamingResponse(
+                    iter_file_range(blob_path, start, end), status_code=206, media_type=media_type, headers=headers
+                )
+            if source == "store":
+                raise HTTPException(status_code=404, detail="Allegato non presente nello store locale.")
+
+        if not os.path.exists(TOKEN_FILE):
+            raise HTTPException(status_code=401, detail="Token non trovato. Autenticati tramite /authenticate.")
+
+        service = await google_service("gmail", "v1")
+        part = await find_attachment_part(service, message_id, part_id)
+        if part is None:
+            raise HTTPException(status_code=404, detail="Allegato non trovato.")
+
+        # Il primo blocco viene letto prima di rispondere, cosi' gli errori di Gmail arrivano come stato HTTP
+        chunks = iter_attachment_data(service, message_id, part["body"]["attachmentId"])
+        first = await anext(chunks, b"")
+
+        async def body():
+            yield first
+            async for chunk in chunks:
+                yield chunk
+
+        return StreamingResponse(
+            body(),
+            media_type=part.get("mimeType") or "application/octet-stream",
+            headers={"Content-Disposition": content_disposition(part["filename"])}
+        )
+
+    except HTTPException:
+        raise
+    except HttpError as e:
+        if getattr(e.resp, "status", None) == 404:
+            raise HTTPException(status_code=404, detail="Allegato non trovato.")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Errore durante la lettura dell'allegato: {str(e)}")
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Errore durante la lettura dell'allegato: {str(e)}")
+
+
+async def collect_message_ids(service, filters, max_messages):
+    """
+    Id delle prime max_messages email che soddisfano i filtri, leggendo piu' pagine se serve
+    """
+    message_ids = []
+    page_token = None
+    while len(message_ids) < max_messages:
+        results = await search_messages(
+            service, filters, min(max_messages - len(message_ids), GMAIL_MAX_PAGE_SIZE), page_token
+        )
+        message_ids.extend(message["id"] for message in results.get("messages", []))
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            break
+    return message_ids
+
+@app.post("/gmail/download-attachments")
+async def download_attachments_bulk(
+    request: BulkDownloadRequest,
+    auth: bool = Depends(verify_api_key)
+):
+    """
+    Allegati di piu' email, per id o con i filtri di read_emails (solo email con allegati), scaricati con
+    concorrenza limitata; la label 'Downloaded' viene assegnata a tutte insieme con batchModify
+    """
+    try:
+        if not os.path.exists(TOKEN_FILE):
+            raise HTTPException(status_code=401, detail="Token non trovato. Autenticati tramite /authenticate.")
+
+        service = await google_service("gmail", "v1")
+
+        if request.message_ids is not None:
+            message_ids = list(dict.fromkeys(request.message_ids))
+            if len(message_ids) > BULK_DOWNLOAD_MAX_MESSAGES:
+                raise HTTPException(
+                    status_code=400, detail=f"Al massimo {BULK_DOWNLOAD_MAX_MESSAGES} email per richiesta."
+                )
+        else:
+            max_messages = max(1, min(request.max_messages, BULK_DOWNLOAD_MAX_MESSAGES))
+            filters = email_filters(
+                request.Label, request.ExcludeLabel, request.Subject, request.ExactSubject, True,
+                request.From, request.Text, request.LabelId, request.ExcludeLabelId
+            )
+            message_ids = await collect_message_ids(service, filters, max_messages)
+
+        # Limite comune a tutte le email, oltre a quello sul numero di email elaborate insieme
+        semaphore = asyncio.Semaphore(ATTACHMENT_FETCH_CONCURRENCY)
+        message_semaphore = asyncio.Semaphore(ATTACHMENT_FETCH_CONCURRENCY)
+        results = {}
+
+        async def process(message_id):
+            async with message_semaphore:
+                try:
+                    results[message_id] = await save_message_attachments(service, message_id, semaphore)
+                except Exception as e:
+                    results[message_id] = {"error": str(e)}
+
+        await asyncio.gather(*(process(message_id) for message_id in message_ids))
+
+        to_label = [message_id for message_id in message_ids if results[message_id].get("needs_label")]
+        label_error = None
+        if to_label:
+            try:
+                await mark_downloaded(service, to_label)
+            except Exception as e:
+                traceback.print_exc()
+                label_error = str(e)
+
+        messages = []
+        for message_id in message_ids:
+            result = results[message_id]
+            if "error" in result:
+                messages.append({"message_id": message_id, "error": result["error"]})
+                continue
+            messages.append({
+                "message_id": message_id,
+                "attachments": result["attachments"],
+                "resumed": result["resumed"],
+                "labeled": bool(result["attachments"]) and not (label_error and message_id in to_label)
+            })
+
+        response = {
+            "messages": messages,
+            "downloaded": sum(len(message.get("attachments", [])) for message in messages),
+            "failed": sum(1 for message in messages if "error" in message)
         }
+        if label_error:
+            response["label_error"] = label_error
+        return response
 
     except HTTPException:
         raise
@@ -578,6 +2968,25 @@ async def download_attachments(
         raise HTTPException(status_code=500, detail=f"Errore durante il download degli allegati: {str(e)}")
 
 
+@app.post("/gmail/sync")
+async def sync_mailbox(auth: bool = Depends(verify_api_key)):
+    """
+    Sincronizza il mirror locale: completo la prima volta, poi solo le modifiche da users.history.list
+    """
+    try:
+        if not os.path.exists(TOKEN_FILE):
+            raise HTTPException(status_code=401, detail="Token non trovato. Autenticati tramite /authenticate.")
+
+        service = await google_service("gmail", "v1")
+        return await run_google(mailbox_mirror.sync, service)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Errore durante la sincronizzazione della casella: {str(e)}")
+
+
 @app.post("/calendar/create-reminder")
 async def create_reminder(
     title: str = Query(..., description="Title of the reminder"),
@@ -591,19 +3000,7 @@ async def create_reminder(
         if not os.path.exists(TOKEN_FILE):
             raise HTTPException(status_code=401, detail="Token not found. Authenticate via /authenticate.")
 
-        with open(TOKEN_FILE, "r") as token:
-            creds_dict = json.load(token)
-
-        creds = google.oauth2.credentials.Credentials(
-            token=creds_dict["token"],
-            refresh_token=creds_dict["refresh_token"],
-            token_uri=creds_dict["token_uri"],
-            client_id=creds_dict["client_id"],
-            client_secret=creds_dict["client_secret"],
-            scopes=creds_dict["scopes"]
-        )
-
-        service = build("calendar", "v3", credentials=creds)
+        service = await google_service("calendar", "v3")
 
         event = {
             'summary': title,
@@ -621,10 +3018,10 @@ async def create_reminder(
             },
         }
 
-        event = service.events().insert(
+        event = await google_execute(service.events().insert(
             calendarId='primary',
             body=event
-        ).execute()
+        ))
 
         return {
             "message": "Reminder created successfully",
@@ -643,34 +3040,29 @@ async def read_reminders(
     auth: bool = Depends(verify_api_key),
     max_results: int = Query(30, description="Maximum number of events to return"),
     time_min: datetime = Query(None, description="Lower bound for event start time"),
-    time_max: datetime = Query(None, description="Upper bound for event end time")
+    time_max: datetime = Query(None, description="Upper bound for event end time"),
+    stream: bool = Query(False, description="Stream events as newline-delimited JSON")
 ):
     try:
         if not os.path.exists(TOKEN_FILE):
             raise HTTPException(status_code=401, detail="Token not found. Authenticate via /authenticate.")
 
-        with open(TOKEN_FILE, "r") as token:
-            creds_dict = json.load(token)
+        service = await google_service("calendar", "v3")
+        list_params = {
+            "calendarId": 'primary',
+            "timeMin": time_min.isoformat() + 'Z' if time_min else None,
+            "timeMax": time_max.isoformat() + 'Z' if time_max else None,
+            "singleEvents": True,
+            "orderBy": 'startTime'
+        }
 
-        creds = google.oauth2.credentials.Credentials(
-            token=creds_dict["token"],
-            refresh_token=creds_dict["refresh_token"],
-            token_uri=creds_dict["token_uri"],
-            client_id=creds_dict["client_id"],
-            client_secret=creds_dict["client_secret"],
-            scopes=creds_dict["scopes"]
-        )
+        if stream:
+            return StreamingResponse(
+                stream_calendar_events(service, list_params, max_results),
+                media_type=NDJSON_MEDIA_TYPE
+            )
 
-        service = build("calendar", "v3", credentials=creds)
-        
-        events_result = service.events().list(
-            calendarId='primary',
-            timeMin=time_min.isoformat() + 'Z' if time_min else None,
-            timeMax=time_max.isoformat() + 'Z' if time_max else None,
-            maxResults=max_results,
-            singleEvents=True,
-            orderBy='startTime'
-        ).execute()
+        events_result = await calendar_list_events(service, maxResults=max_results, **list_params)
 
         events = events_result.get('items', [])
         return {"events": events}
@@ -690,20 +3082,8 @@ async def remove_reminder(
         if not os.path.exists(TOKEN_FILE):
             raise HTTPException(status_code=401, detail="Token not found. Authenticate via /authenticate.")
 
-        with open(TOKEN_FILE, "r") as token:
-            creds_dict = json.load(token)
-
-        creds = google.oauth2.credentials.Credentials(
-            token=creds_dict["token"],
-            refresh_token=creds_dict["refresh_token"],
-            token_uri=creds_dict["token_uri"],
-            client_id=creds_dict["client_id"],
-            client_secret=creds_dict["client_secret"],
-            scopes=creds_dict["scopes"]
-        )
-
-        service = build("calendar", "v3", credentials=creds)
-        service.events().delete(calendarId='primary', eventId=event_id).execute()
+        service = await google_service("calendar", "v3")
+        await google_execute(service.events().delete(calendarId='primary', eventId=event_id))
 
         return {"message": "Reminder removed successfully"}
 
@@ -721,25 +3101,43 @@ async def check_and_download_emails():
     async with httpx.AsyncClient(headers={"X-API-Key": API_KEY}, timeout=30.0) as client:
         while True:
             try:
-                response = await client.get(
-                    f"{BASE_URL}/gmail/read-emails",
-                    params={"HasAttachment": True, "ExcludeLabel": "Downloaded"}
-                )
+                emails = None
+                if MAILBOX_SYNC and os.path.exists(TOKEN_FILE):
+                    # Delta da users.history.list invece di cercare in tutta la casella
+                    try:
+                        service = await google_service("gmail", "v1")
+                        stats = await run_google(mailbox_mirror.sync, service)
+                        logger.info(f"Sync casella: {stats}")
+                        # Durante la prima sincronizzazione completa il mirror e' parziale: si usa la ricerca Gmail
+                        if await run_google(mailbox_mirror.get_state, "history_id") is not None:
+                            pending = await run_google(mailbox_mirror.pending_attachment_downloads, MONITOR_MAX_EMAILS)
+                            emails = [{"id": message_id} for message_id in pending]
+                    except Exception as e:
+                        logger.warning(f"Sync casella fallito, uso la ricerca Gmail: {str(e)}")
+
+                if emails is None:
+                    response = await client.get(
+                        f"{BASE_URL}/gmail/read-emails",
+                        params={"HasAttachment": True, "ExcludeLabel": "Downloaded"}
+                    )
+                    if response.status_code == 200:
+                        emails = response.json().get("emails", [])
 
-                if response.status_code == 200:
-                    emails = response.json().get("emails", [])
+                if emails is not None:
                     if emails:
-                        for email in emails:
-                            # Scarica gli allegati dell'email
-                            email_id = email["id"]
-                            download_response = await client.get(
-                                f"{BASE_URL}/gmail/download-attachments/{email_id}"
-                            )
-                            print(f"{BASE_URL}/gmail/download-attachments/{email_id}")
-                            if download_response.status_code == 200:
-                                print(f"Allegati scaricati per l'email con ID: {email_id}")
-                            else:
-                                print(f"Errore nel download per l'email con ID: {email_id}")
+                        # Scarica gli allegati di tutte le email con una sola richiesta
+                        download_response = await client.post(
+                            f"{BASE_URL}/gmail/download-attachments",
+                            json={"message_ids": [email["id"] for email in emails]}
+                        )
+                        if download_response.status_code == 200:
+                            for result in download_response.json().get("messages", []):
+                                if "error" in result:
+                                    print(f"Errore nel download per l'email con ID: {result['message_id']}")
+                                else:
+                                    print(f"Allegati scaricati per l'email con ID: {result['message_id']}")
+                        else:
+                            print(f"Errore nel download degli allegati: {download_response.status_code}")
                     else:
                         print("Nessuna nuova email con allegati da scaricare.")
                 else:
@@ -750,10 +3148,53 @@ async def check_and_download_emails():
             # Aspetta 60 minuti prima di eseguire di nuovo
             await asyncio.sleep(3600)
 
+async def sync_mailbox_in_background():
+    """
+    Mantiene aggiornato il mirror locale (e quindi l'indice di read_emails) ogni MAILBOX_SYNC_INTERVAL secondi
+    """
+    while True:
+        try:
+            if os.path.exists(TOKEN_FILE):
+                service = await google_service("gmail", "v1")
+                await run_google(mailbox_mirror.sync, service)
+        except Exception as e:
+            logger.warning(f"Sync della casella in background fallito: {str(e)}")
+
+        await asyncio.sleep(MAILBOX_SYNC_INTERVAL)
+
+async def refresh_token_in_background():
+    """
+    Aggiorna il token TOKEN_REFRESH_MARGIN secondi prima della scadenza,
+    cosi' le richieste degli utenti non pagano mai la latenza del refresh OAuth
+    """
+    while True:
+        delay = TOKEN_REFRESH_RETRY
+        try:
+            if os.path.exists(TOKEN_FILE):
+                expires_in = await asyncio.to_thread(google_services.refresh_if_expiring, TOKEN_REFRESH_MARGIN)
+                if expires_in is not None:
+                    delay = max(expires_in - TOKEN_REFRESH_MARGIN, TOKEN_REFRESH_RETRY)
+        except Exception as e:
+            logger.warning(f"Refresh del token in background fallito: {str(e)}")
+
+        await asyncio.sleep(delay)
+
 @app.on_event("startup")
 async def startup_event():
+    # Carica i discovery document una sola volta, prima delle richieste
+    for name, version in DISCOVERY_SERVICES:
+        load_discovery_document(name, version)
     # Avvia la funzione di monitoraggio al momento dello startup
     asyncio.create_task(check_and_download_emails())
+    asyncio.create_task(refresh_token_in_background())
+    if MAILBOX_SYNC:
+        asyncio.create_task(sync_mailbox_in_background())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await google_http.aclose()
+    mailbox_mirror.close()
+    attachment_store.close()
 
 if __name__ == "__main__":
     import uvicorn
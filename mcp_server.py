@@ -79,8 +79,12 @@ async def handle_list_tools() -> list[types.Tool]:
                     },
                     "max_results": {
                         "type": "integer",
-                        "description": "Maximum number of emails to return (default 10)",
+                        "description": "Maximum number of emails to return per page (default 10, max 500)",
                         "default": 10
+                    },
+                    "cursor": {
+                        "type": "string",
+                        "description": "Cursor returned as next_cursor by a previous call, to read the next page with the same filters"
                     }
                 }
             }
@@ -122,16 +126,21 @@ async def handle_list_tools() -> list[types.Tool]:
         ),
         types.Tool(
             name="download_attachments",
-            description="Download all attachments from a specific email by message ID and apply 'Downloaded' label to the email",
+            description="Download all attachments from one or more emails by message ID and apply 'Downloaded' label to them",
             inputSchema={
                 "type": "object",
                 "properties": {
                     "message_id": {
                         "type": "string",
                         "description": "Gmail message ID (obtained from read_emails)"
+                    },
+                    "message_ids": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "Several Gmail message IDs, downloaded with a single request (max 500)"
                     }
                 },
-                "required": ["message_id"]
+                "required": []
             }
         ),
         types.Tool(
@@ -244,7 +253,8 @@ async def read_emails(args: Dict[str, Any]) -> list[types.TextContent]:
         "HasAttachment": args.get("HasAttachment", False),
         "From": args.get("From", ""),
         "Text": args.get("Text", ""),
-        "max_results": args.get("max_results", 10)
+        "max_results": args.get("max_results", 10),
+        "cursor": args.get("cursor", "")
     }
 
     # Remove empty parameters
@@ -270,6 +280,9 @@ async def read_emails(args: Dict[str, Any]) -> list[types.TextContent]:
     else:
         formatted = "No emails found matching the criteria."
 
+    if data.get("next_cursor"):
+        formatted += f"\n\nMore results available. next_cursor: {data['next_cursor']}"
+
     return [types.TextContent(type="text", text=formatted)]
 
 
@@ -305,7 +318,11 @@ async def send_email(args: Dict[str, Any]) -> list[types.TextContent]:
 
 async def download_attachments(args: Dict[str, Any]) -> list[types.TextContent]:
     """Download email attachments"""
-    message_id = args["message_id"]
+    if args.get("message_ids"):
+        return await download_attachments_bulk(args["message_ids"])
+    message_id = args.get("message_id")
+    if not message_id:
+        raise ValueError("Specify message_id or message_ids.")
 
     response = await http_client.get(f"/gmail/download-attachments/{message_id}")
     response.raise_for_status()
@@ -330,6 +347,32 @@ async def download_attachments(args: Dict[str, Any]) -> list[types.TextContent]:
     return [types.TextContent(type="text", text=result)]
 
 
+async def download_attachments_bulk(message_ids: list[str]) -> list[types.TextContent]:
+    """Download attachments of several emails with one request"""
+    response = await http_client.post("/gmail/download-attachments", json={"message_ids": message_ids})
+    response.raise_for_status()
+
+    data = response.json()
+
+    lines = []
+    for message in data.get("messages", []):
+        if "error" in message:
+            lines.append(f"- {message['message_id']}: ❌ {message['error']}")
+            continue
+        attachments = message.get("attachments", [])
+        files = ", ".join(f"{att.get('filename', 'N/A')} → {att.get('file_path', 'N/A')}" for att in attachments)
+        lines.append(f"- {message['message_id']}: {files or 'no attachments'}")
+
+    result = (
+        f"✅ Downloaded {data.get('downloaded', 0)} attachment(s) from {len(data.get('messages', []))} email(s):\n\n" +
+        "\n".join(lines)
+    )
+    if data.get("label_error"):
+        result += f"\n\n⚠️ 'Downloaded' label not applied: {data['label_error']}"
+
+    return [types.TextContent(type="text", text=result)]
+
+
 async def create_calendar_reminder(args: Dict[str, Any]) -> list[types.TextContent]:
     """Create calendar reminder"""
     params = {
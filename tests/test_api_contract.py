@@ -1,18 +1,169 @@
+import asyncio
+import email
+import io
 import json
 import os
+import shutil
 import tempfile
+import threading
 import unittest
+from datetime import datetime, timedelta
+from unittest import mock
 
+import httplib2
+import httpx
 from fastapi import HTTPException
+from googleapiclient.errors import HttpError
 
 import main
 
 
+class FakeRequest:
+    def __init__(self, func):
+        self.func = func
+
+    def execute(self, http=None):
+        return self.func()
+
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        self.service.batch_calls += 1
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, request.execute(), None)
+            except HttpError as e:
+                self.callback(request_id, None, e)
+
+
+def http_error(status):
+    return HttpError(resp=httplib2.Response({"status": status}), content=b"error")
+
+
+class FakeGmailService(mock.MagicMock):
+    """Servizio Gmail finto: messages.get restituisce i messaggi in self.messages."""
+
+    def configure(self, messages):
+        self.messages = messages
+        self.batch_calls = 0
+        self.new_batch_http_request.side_effect = lambda callback: FakeBatch(self, callback)
+        self.users.return_value.messages.return_value.get.side_effect = (
+            lambda userId, id, **params: FakeRequest(lambda: self.get_message(id, params))
+        )
+        self.users.return_value.messages.return_value.list.side_effect = (
+            lambda userId, **params: FakeRequest(lambda: self.list_messages(params))
+        )
+        self.get_params = []
+        self.history = []
+        self.labels = [{"id": "INBOX", "name": "INBOX"}, {"id": "Label_D", "name": "Downloaded"}]
+        users = self.users.return_value
+        users.messages.return_value.batchModify.side_effect = lambda userId, body: FakeRequest(lambda: {})
+        users.getProfile.side_effect = lambda userId: FakeRequest(lambda: {"historyId": "100"})
+        users.labels.return_value.list.side_effect = lambda userId: FakeRequest(lambda: {"labels": self.labels})
+        users.history.return_value.list.side_effect = (
+            lambda userId, **params: FakeRequest(lambda: self.list_history(params))
+        )
+        return self
+
+    def list_history(self, params):
+        if isinstance(self.history, Exception):
+            raise self.history
+        return {"history": self.history, "historyId": "200"}
+
+    def list_messages(self, params):
+        start = int(params.get("pageToken") or 0)
+        end = start + params.get("maxResults", 100)
+        ids = list(self.messages)
+        result = {"messages": [{"id": message_id} for message_id in ids[start:end]]}
+        if end < len(ids):
+            result["nextPageToken"] = str(end)
+        return result
+
+    def get_message(self, message_id, params):
+        self.get_params.append(params)
+        message = self.messages[message_id]
+        if isinstance(message, list):
+            message = message.pop(0)
+        if isinstance(message, Exception):
+            raise message
+        return message
+
+
+def metadata_message(message_id, subject="Subject", sender="sender@example.com", **headers):
+    return {
+        "id": message_id,
+        "snippet": f"snippet {message_id}",
+        "labelIds": ["INBOX"],
+        "payload": {"headers": [{"name": "Subject", "value": subject}, {"name": "From", "value": sender}]
+                    + [{"name": name, "value": value} for name, value in headers.items()]},
+    }
+
+
+def full_message(message_id, labels=("INBOX",), attachment=None, internal_date=0):
+    message = metadata_message(message_id)
+    message["labelIds"] = list(labels)
+    message["internalDate"] = str(internal_date)
+    message["payload"]["parts"] = [{"partId": "0", "mimeType": "text/plain", "filename": "", "body": {"size": 1}}]
+    if attachment:
+        message["payload"]["parts"].append({
+            "partId": "1", "mimeType": "application/pdf", "filename": attachment,
+            "body": {"attachmentId": f"att-{message_id}", "size": 3}
+        })
+    return message
+
+
+READ_EMAILS_DEFAULTS = {
+    "Label": None,
+    "ExcludeLabel": None,
+    "Subject": None,
+    "ExactSubject": None,
+    "HasAttachment": False,
+    "From": None,
+    "Text": None,
+    "max_results": 10,
+    "headers": None,
+    "cursor": None,
+    "stream": False,
+    "source": "auto",
+    "LabelId": None,
+    "ExcludeLabelId": None,
+}
+
+
 class ApiContractTests(unittest.IsolatedAsyncioTestCase):
     def setUp(self):
         self.original_token_file = main.TOKEN_FILE
         self.original_api_key = main.API_KEY
         main.API_KEY = "test-key"
+        for name, value in (
+            ("message_cache", main.MessageSummaryCache(100)),
+            ("query_cache", main.QueryResultCache(30, 100)),
+            ("label_directory", main.LabelDirectory(600)),
+        ):
+            cache_patcher = mock.patch.object(main, name, value)
+            cache_patcher.start()
+            self.addCleanup(cache_patcher.stop)
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir, True)
+        self.mirror = main.MailboxMirror(os.path.join(self.temp_dir, "mailbox.sqlite3"))
+        self.addCleanup(self.mirror.close)
+        mirror_patcher = mock.patch.object(main, "mailbox_mirror", self.mirror)
+        mirror_patcher.start()
+        self.addCleanup(mirror_patcher.stop)
+        self.attachment_dir = os.path.join(self.temp_dir, "attachments")
+        self.store = main.AttachmentStore(self.attachment_dir, os.path.join(self.attachment_dir, ".store"))
+        store_patcher = mock.patch.object(main, "attachment_store", self.store)
+        store_patcher.start()
+        self.addCleanup(store_patcher.stop)
+        self.addCleanup(self.store.close)
 
     def tearDown(self):
         main.TOKEN_FILE = self.original_token_file
@@ -89,6 +240,1020 @@ class ApiContractTests(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(ctx.exception.status_code, 401)
         self.assertIn("Token non trovato", ctx.exception.detail)
 
+    def test_credentials_from_dict_accepts_utc_expiry_from_google_auth(self):
+        token = {
+            "token": "x", "refresh_token": "r", "token_uri": "https://oauth2.googleapis.com/token",
+            "client_id": "id", "client_secret": "secret", "scopes": main.SCOPES
+        }
+        credentials = main.credentials_from_dict({**token, "expiry": "2099-01-01T10:00:00Z"})
+        self.assertEqual(credentials.expiry, datetime(2099, 1, 1, 10, 0))
+        self.assertTrue(credentials.valid)
+
+        credentials = main.credentials_from_dict({**token, "expiry": "2099-01-01T12:00:00+02:00"})
+        self.assertEqual(credentials.expiry, datetime(2099, 1, 1, 10, 0))
+
+    def test_service_cache_rebuilds_only_when_token_changes(self):
+        with tempfile.NamedTemporaryFile("w", delete=False, suffix=".json") as f:
+            json.dump({
+                "token": "x",
+                "refresh_token": "r",
+                "token_uri": "https://oauth2.googleapis.com/token",
+                "client_id": "id",
+                "client_secret": "secret",
+                "scopes": main.SCOPES,
+                "expiry": (datetime.utcnow() + timedelta(hours=1)).isoformat(),
+            }, f)
+            temp_path = f.name
+
+        try:
+            main.TOKEN_FILE = temp_path
+            cache = main.GoogleServiceCache()
+            with mock.patch.object(main, "build_from_document", side_effect=lambda *a, **k: object()) as build:
+                first = cache.service("gmail", "v1")
+                self.assertIs(cache.service("gmail", "v1"), first)
+                self.assertEqual(build.call_count, 1)
+
+                stat = os.stat(temp_path)
+                os.utime(temp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+                self.assertIsNot(cache.service("gmail", "v1"), first)
+                self.assertEqual(build.call_count, 2)
+        finally:
+            os.remove(temp_path)
+
+    def test_discovery_documents_are_loaded_once_without_network(self):
+        main._discovery_documents.clear()
+        with mock.patch.object(main, "get_static_doc", wraps=main.get_static_doc) as static_doc:
+            gmail = main.load_discovery_document("gmail", "v1")
+            self.assertIs(main.load_discovery_document("gmail", "v1"), gmail)
+            self.assertEqual(static_doc.call_count, 1)
+        self.assertEqual(gmail["name"], "gmail")
+
+    def test_expired_token_is_refreshed_once_and_saved(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, True)
+        main.TOKEN_FILE = os.path.join(temp_dir, "token.json")
+        with open(main.TOKEN_FILE, "w") as f:
+            json.dump({
+                "token": "old",
+                "refresh_token": "r",
+                "token_uri": "https://oauth2.googleapis.com/token",
+                "client_id": "id",
+                "client_secret": "secret",
+                "scopes": main.SCOPES,
+                "expiry": (datetime.utcnow() - timedelta(minutes=5)).isoformat(),
+            }, f)
+
+        def fake_refresh(credentials, request):
+            credentials.token = "new"
+            credentials.expiry = datetime.utcnow() + timedelta(hours=1)
+
+        cache = main.GoogleServiceCache()
+        with mock.patch.object(main.google.oauth2.credentials.Credentials, "refresh", autospec=True, side_effect=fake_refresh) as refresh:
+            threads = [threading.Thread(target=cache.credentials) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(refresh.call_count, 1)
+        with open(main.TOKEN_FILE) as f:
+            saved = json.load(f)
+        self.assertEqual(saved["token"], "new")
+        self.assertIsNotNone(saved["expiry"])
+        self.assertEqual(cache.credentials().token, "new")
+
+    def test_refresh_if_expiring_honours_margin(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, True)
+        main.TOKEN_FILE = os.path.join(temp_dir, "token.json")
+        with open(main.TOKEN_FILE, "w") as f:
+            json.dump({
+                "token": "old",
+                "refresh_token": "r",
+                "token_uri": "https://oauth2.googleapis.com/token",
+                "client_id": "id",
+                "client_secret": "secret",
+                "scopes": main.SCOPES,
+                "expiry": (datetime.utcnow() + timedelta(minutes=10)).isoformat(),
+            }, f)
+
+        def fake_refresh(credentials, request):
+            credentials.token = "new"
+            credentials.expiry = datetime.utcnow() + timedelta(hours=1)
+
+        cache = main.GoogleServiceCache()
+        with mock.patch.object(main.google.oauth2.credentials.Credentials, "refresh", autospec=True, side_effect=fake_refresh) as refresh:
+            self.assertGreater(cache.refresh_if_expiring(60), 500)
+            self.assertEqual(refresh.call_count, 0)
+            self.assertGreater(cache.refresh_if_expiring(900), 3500)
+            self.assertEqual(refresh.call_count, 1)
+
+        status = cache.token_status()
+        self.assertGreater(status["expires_in_seconds"], 3500)
+        self.assertIsNotNone(status["last_refresh"])
+
+    def test_batch_get_messages_chunks_and_handles_partial_failures(self):
+        messages = {str(i): {"id": str(i)} for i in range(120)}
+        messages["bad"] = http_error(404)
+        messages["flaky"] = [http_error(503), {"id": "flaky"}]
+        service = FakeGmailService().configure(messages)
+
+        with mock.patch.object(main.time, "sleep"), \
+                mock.patch.object(main.google_services, "credentials", return_value=mock.Mock()):
+            fetched, errors = main.batch_get_messages(service, list(messages))
+
+        self.assertEqual(len(fetched), 121)
+        self.assertIn("flaky", fetched)
+        self.assertEqual(list(errors), ["bad"])
+        # 122 richieste in batch da 50 + un batch per il nuovo tentativo
+        self.assertEqual(service.batch_calls, 4)
+
+    def use_fake_gmail(self, messages):
+        service = FakeGmailService().configure(messages)
+        with tempfile.NamedTemporaryFile("w", delete=False, suffix=".json") as f:
+            f.write("{}")
+        self.addCleanup(os.remove, f.name)
+        main.TOKEN_FILE = f.name
+        for name, value in (("service", service), ("credentials", mock.Mock())):
+            patcher = mock.patch.object(main.google_services, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return service
+
+    async def test_read_emails_requests_metadata_with_extra_headers(self):
+        service = self.use_fake_gmail({
+            "a": metadata_message("a", subject="Hello", Date="Mon, 1 Jan 2024"),
+        })
+
+        result = await main.read_emails(auth=True, **{**READ_EMAILS_DEFAULTS, "headers": "Date, date,To"})
+
+        self.assertEqual(result["emails"][0]["subject"], "Hello")
+        self.assertEqual(result["emails"][0]["headers"], {"Date": "Mon, 1 Jan 2024", "To": None})
+        params = service.get_params[0]
+        self.assertEqual(params["format"], "metadata")
+        self.assertEqual(params["metadataHeaders"], ["Subject", "From", "Date", "To"])
+        self.assertEqual(params["fields"], main.SUMMARY_FIELDS)
+
+    async def test_read_emails_walks_pages_with_cursor(self):
+        self.use_fake_gmail({str(i): metadata_message(str(i)) for i in range(5)})
+        params = {**READ_EMAILS_DEFAULTS, "max_results": 2, "Label": "INBOX"}
+
+        seen = []
+        cursor = None
+        while True:
+            result = await main.read_emails(auth=True, **{**params, "cursor": cursor})
+            seen.extend(email["id"] for email in result["emails"])
+            cursor = result["next_cursor"]
+            if not cursor:
+                break
+
+        self.assertEqual(seen, ["0", "1", "2", "3", "4"])
+
+    async def test_read_emails_rejects_cursor_from_other_query(self):
+        self.use_fake_gmail({str(i): metadata_message(str(i)) for i in range(5)})
+        first = await main.read_emails(auth=True, **{**READ_EMAILS_DEFAULTS, "max_results": 2, "Label": "INBOX"})
+
+        with self.assertRaises(HTTPException) as ctx:
+            await main.read_emails(auth=True, **{**READ_EMAILS_DEFAULTS, "max_results": 2, "cursor": first["next_cursor"]})
+        self.assertEqual(ctx.exception.status_code, 400)
+
+        # Offset dell'indice non numerico o negativo, sorgente sconosciuta
+        for page_token, source in (("abc", "index"), ("-1", "index"), ("2", "other")):
+            cursor = main.encode_cursor(main.filters_scope(main.email_filters()), page_token, source)
+            with self.assertRaises(HTTPException) as ctx:
+                await main.read_emails(auth=True, **{**READ_EMAILS_DEFAULTS, "cursor": cursor})
+            self.assertEqual(ctx.exception.status_code, 400)
+
+        with self.assertRaises(HTTPException) as ctx:
+            await main.read_emails(auth=True, **{**READ_EMAILS_DEFAULTS, "source": "foo"})
+        self.assertEqual(ctx.exception.status_code, 400)
+
+    async def test_read_emails_stream_emits_ndjson_across_pages(self):
+        self.use_fake_gmail({str(i): metadata_message(str(i)) for i in range(7)})
+
+        response = await main.read_emails(auth=True, **{**READ_EMAILS_DEFAULTS, "max_results": 6, "stream": True})
+        self.assertEqual(response.media_type, "application/x-ndjson")
+
+        with mock.patch.object(main, "GMAIL_MAX_PAGE_SIZE", 4):
+            lines = [json.loads(line) async for line in response.body_iterator]
+
+        self.assertEqual([line["id"] for line in lines[:-1]], ["0", "1", "2", "3", "4", "5"])
+        self.assertIsNotNone(lines[-1]["next_cursor"])
+
+    def test_thread_http_is_private_to_each_thread(self):
+        credentials = mock.Mock()
+        transports = {}
+
+        def collect(name):
+            transports[name] = (main.thread_http(), main.thread_http())
+
+        with mock.patch.object(main.google_services, "credentials", return_value=credentials):
+            threads = [threading.Thread(target=collect, args=(i,)) for i in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertIs(transports[0][0], transports[0][1])
+        self.assertIsNot(transports[0][0], transports[1][0])
+        self.assertIs(transports[0][0].credentials, credentials)
+
+    async def test_read_emails_with_httpx_backend(self):
+        self.use_fake_gmail({})
+        requests_seen = []
+        failures = {"b": 1}
+
+        def handler(request):
+            requests_seen.append(request)
+            self.assertEqual(request.headers["Authorization"], "Bearer token")
+            if request.url.path.endswith("/messages"):
+                self.assertEqual(request.url.params["labelIds"], "INBOX")
+                return httpx.Response(200, json={"messages": [{"id": "a"}, {"id": "b"}], "nextPageToken": "p2"})
+            message_id = request.url.path.rsplit("/", 1)[-1]
+            self.assertEqual(request.url.params.get_list("metadataHeaders"), ["Subject", "From"])
+            if failures.get(message_id):
+                failures[message_id] -= 1
+                return httpx.Response(503, json={})
+            return httpx.Response(200, json=metadata_message(message_id))
+
+        client = main.GoogleAsyncClient()
+        client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        client._semaphore = asyncio.Semaphore(4)
+        credentials = mock.Mock(valid=True, token="token")
+        with mock.patch.object(main, "google_http", client), \
+                mock.patch.object(main, "GOOGLE_API_BACKEND", "httpx"), \
+                mock.patch.object(main.google_services, "current_credentials", return_value=credentials), \
+                mock.patch.object(main.asyncio, "sleep", mock.AsyncMock()):
+            result = await main.read_emails(auth=True, **{**READ_EMAILS_DEFAULTS, "Label": "INBOX"})
+        await client.aclose()
+
+        self.assertEqual([email["id"] for email in result["emails"]], ["a", "b"])
+        self.assertIsNotNone(result["next_cursor"])
+        self.assertEqual(len(requests_seen), 4)
+
+    async def test_read_emails_serves_repeated_listing_from_cache(self):
+        service = self.use_fake_gmail({str(i): metadata_message(str(i)) for i in range(3)})
+        params = {**READ_EMAILS_DEFAULTS, "max_results": 3}
+
+        first = await main.read_emails(auth=True, **params)
+        second = await main.read_emails(auth=True, **params)
+        self.assertEqual(first["emails"], second["emails"])
+        self.assertEqual(len(service.get_params), 3)
+        self.assertEqual(main.message_cache.stats()["hits"], 3)
+
+        # Label scadute: si rilegge solo labelIds
+        service.messages["1"] = {"id": "1", "labelIds": ["INBOX", "Label_9"]}
+        with mock.patch.object(main, "MESSAGE_LABEL_TTL", -1):
+            third = await main.read_emails(auth=True, **params)
+        self.assertEqual(third["emails"][1]["labels"], ["INBOX", "Label_9"])
+        self.assertEqual(third["emails"][1]["subject"], "Subject")
+        self.assertEqual(service.get_params[-1], {"format": "minimal", "fields": "id,labelIds"})
+
+        # Header aggiuntivi non in cache: il messaggio viene riletto
+        await main.read_emails(auth=True, **{**params, "headers": "Date"})
+        self.assertEqual(len(service.get_params), 9)
+
+    def test_mailbox_mirror_full_then_incremental_sync(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, True)
+        mirror = main.MailboxMirror(os.path.join(temp_dir, "mailbox.sqlite3"))
+        self.addCleanup(mirror.close)
+        service = FakeGmailService().configure({
+            "a": full_message("a", attachment="a.pdf", internal_date=2),
+            "b": full_message("b", internal_date=1),
+        })
+
+        with mock.patch.object(main.google_services, "credentials", return_value=mock.Mock()):
+            stats = mirror.sync(service)
+            self.assertEqual((stats["mode"], stats["added"]), ("full", 2))
+            self.assertEqual(mirror.get_state("history_id"), "100")
+            self.assertEqual(mirror.pending_attachment_downloads(10), ["a"])
+
+            service.messages["c"] = full_message("c", attachment="c.pdf", internal_date=3)
+            service.history = [
+                {"messagesAdded": [{"message": {"id": "c"}}]},
+                {"messagesDeleted": [{"message": {"id": "b"}}]},
+                {"labelsAdded": [{"message": {"id": "a", "labelIds": ["INBOX", "Label_D"]}}]},
+            ]
+            calls_before = len(service.get_params)
+            stats = mirror.sync(service)
+
+        self.assertEqual(stats, {
+            "mode": "incremental", "added": 1, "deleted": 1, "relabeled": 1, "pending": 0, "history_id": "200"
+        })
+        self.assertEqual(len(service.get_params) - calls_before, 1)
+        self.assertEqual(mirror.get_state("history_id"), "200")
+        self.assertEqual(mirror.pending_attachment_downloads(10), ["c"])
+        ids = [row[0] for row in mirror.db.execute("SELECT id FROM messages ORDER BY id")]
+        self.assertEqual(ids, ["a", "c"])
+
+    def test_mailbox_mirror_sync_does_not_wait_for_running_sync(self):
+        service = FakeGmailService().configure({"a": full_message("a")})
+        self.mirror._sync_lock.acquire()
+        try:
+            self.assertEqual(self.mirror.sync(service), {"mode": "in_progress"})
+        finally:
+            self.mirror._sync_lock.release()
+        self.assertEqual(service.users.return_value.getProfile.call_count, 0)
+
+        with mock.patch.object(main.google_services, "credentials", return_value=mock.Mock()):
+            self.assertEqual(self.mirror.sync(service)["mode"], "full")
+
+    def test_mailbox_mirror_resyncs_when_history_expired(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, True)
+        mirror = main.MailboxMirror(os.path.join(temp_dir, "mailbox.sqlite3"))
+        self.addCleanup(mirror.close)
+        service = FakeGmailService().configure({"a": full_message("a")})
+
+        with mock.patch.object(main.google_services, "credentials", return_value=mock.Mock()):
+            mirror.sync(service)
+            service.history = http_error(404)
+            stats = mirror.sync(service)
+
+        self.assertEqual(stats["mode"], "full")
+
+    def test_mailbox_mirror_refetches_messages_that_failed_to_load(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, True)
+        mirror = main.MailboxMirror(os.path.join(temp_dir, "mailbox.sqlite3"))
+        self.addCleanup(mirror.close)
+        service = FakeGmailService().configure({
+            "a": full_message("a", internal_date=2),
+            "b": [http_error(429), http_error(429), full_message("b", attachment="b.pdf", internal_date=1)],
+            "gone": http_error(404),
+        })
+
+        with mock.patch.object(main.google_services, "credentials", return_value=mock.Mock()), \
+                mock.patch.object(main.time, "sleep"):
+            stats = mirror.sync(service)
+            self.assertEqual(stats["pending"], 1)
+            self.assertEqual(mirror.get_state("history_id"), "100")
+
+            stats = mirror.sync(service)
+
+        self.assertEqual((stats["mode"], stats["added"], stats["pending"]), ("incremental", 1, 0))
+        ids = [row[0] for row in mirror.db.execute("SELECT id FROM messages ORDER BY id")]
+        self.assertEqual(ids, ["a", "b"])
+        self.assertEqual(mirror.pending_attachment_downloads(10), ["b"])
+
+    def test_mailbox_mirror_resumes_interrupted_full_sync(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, True)
+        mirror = main.MailboxMirror(os.path.join(temp_dir, "mailbox.sqlite3"))
+        self.addCleanup(mirror.close)
+        service = FakeGmailService().configure({str(i): full_message(str(i), internal_date=i) for i in range(5)})
+        list_messages = service.list_messages
+        page_tokens = []
+        failures = {"2": 1}
+
+        def flaky_list(params):
+            token = params.get("pageToken")
+            page_tokens.append(token)
+            if failures.get(token):
+                failures[token] -= 1
+                raise http_error(503)
+            return list_messages(params)
+
+        service.list_messages = flaky_list
+        with mock.patch.object(main.google_services, "credentials", return_value=mock.Mock()), \
+                mock.patch.object(main, "GMAIL_MAX_PAGE_SIZE", 2):
+            with self.assertRaises(HttpError):
+                mirror.sync(service)
+            self.assertIsNone(mirror.get_state("history_id"))
+
+            stats = mirror.sync(service)
+
+        self.assertEqual(page_tokens, [None, "2", "2", "4"])
+        self.assertEqual((stats["mode"], stats["added"], stats["history_id"]), ("full", 3, "100"))
+        self.assertEqual(service.users.return_value.getProfile.call_count, 1)
+        ids = [row[0] for row in mirror.db.execute("SELECT id FROM messages ORDER BY id")]
+        self.assertEqual(ids, ["0", "1", "2", "3", "4"])
+        self.assertIsNone(mirror.get_state("full_sync_page_token"))
+
+    async def test_read_emails_served_from_fresh_local_index(self):
+        service = self.use_fake_gmail({
+            "a": full_message("a", attachment="fattura.pdf", internal_date=3),
+            "b": full_message("b", labels=("INBOX", "Label_D"), internal_date=2),
+            "c": full_message("c", labels=("SPAM",), internal_date=1),
+        })
+        service.messages["a"]["payload"]["headers"][0]["value"] = "Fattura marzo"
+        await main.run_google(self.mirror.sync, service)
+        gmail_calls = len(service.get_params)
+
+        result = await main.read_emails(auth=True, **{**READ_EMAILS_DEFAULTS, "Subject": "fattura"})
+        self.assertEqual(result["source"], "index")
+        self.assertEqual([email["id"] for email in result["emails"]], ["a"])
+
+        result = await main.read_emails(auth=True, **{**READ_EMAILS_DEFAULTS, "ExcludeLabel": "Downloaded"})
+        self.assertEqual([email["id"] for email in result["emails"]], ["a"])
+
+        first = await main.read_emails(auth=True, **{**READ_EMAILS_DEFAULTS, "max_results": 1, "Label": "INBOX"})
+        second = await main.read_emails(
+            auth=True, **{**READ_EMAILS_DEFAULTS, "max_results": 1, "Label": "INBOX", "cursor": first["next_cursor"]}
+        )
+        self.assertEqual([first["emails"][0]["id"], second["emails"][0]["id"]], ["a", "b"])
+        self.assertIsNone(second["next_cursor"])
+        self.assertEqual(second["emails"][0]["labels"], ["INBOX", "Label_D"])
+        self.assertEqual(len(service.get_params), gmail_calls)
+
+        # Il corpo non e' nell'indice: Text va a Gmail, salvo source=index esplicito
+        result = await main.read_emails(auth=True, **{**READ_EMAILS_DEFAULTS, "Text": "fattura"})
+        self.assertEqual(result["source"], "gmail")
+        self.assertEqual(service.users.return_value.messages.return_value.list.call_args.kwargs["q"], '"fattura"')
+        result = await main.read_emails(auth=True, **{**READ_EMAILS_DEFAULTS, "Text": "fattura", "source": "index"})
+        self.assertEqual(result["source"], "index")
+
+        # La label assegnata dal download compare subito nell'indice, senza attendere il sync
+        service.users.return_value.messages.return_value.attachments.return_value.get.side_effect = (
+            lambda userId, messageId, id, **params: FakeRequest(lambda: {"data": "cGRm"})
+        )
+        await main.download_attachments("a", auth=True)
+        result = await main.read_emails(auth=True, **{**READ_EMAILS_DEFAULTS, "ExcludeLabel": "Downloaded"})
+        self.assertEqual((result["source"], result["emails"]), ("index", []))
+        self.assertEqual(self.mirror.pending_attachment_downloads(10), [])
+
+        with mock.patch.object(main, "MAILBOX_INDEX_MAX_AGE", -1):
+            result = await main.read_emails(auth=True, **READ_EMAILS_DEFAULTS)
+        self.assertEqual(result["source"], "gmail")
+
+    def test_query_cache_key_is_canonical(self):
+        first = main.email_filters(Label="INBOX", From="  Alice@Example.com ", HasAttachment=True)
+        second = main.email_filters(From="alice@example.com", Label="inbox", HasAttachment=True)
+        self.assertEqual(main.query_cache_key(first, 10, None), main.query_cache_key(second, 10, ""))
+        self.assertNotEqual(main.query_cache_key(first, 10, None), main.query_cache_key(first, 20, None))
+
+    async def test_read_emails_reuses_cached_list_until_invalidated(self):
+        service = self.use_fake_gmail({"a": metadata_message("a")})
+        messages_api = service.users.return_value.messages.return_value
+        params = {**READ_EMAILS_DEFAULTS, "Label": "INBOX", "source": "gmail"}
+
+        await main.read_emails(auth=True, **params)
+        await main.read_emails(auth=True, **{**params, "Label": "inbox "})
+        self.assertEqual(messages_api.list.call_count, 1)
+
+        main.query_cache.invalidate()
+        await main.read_emails(auth=True, **params)
+        self.assertEqual(messages_api.list.call_count, 2)
+
+        with mock.patch.object(main.time, "monotonic", return_value=main.time.monotonic() + 3600):
+            await main.read_emails(auth=True, **params)
+        self.assertEqual(messages_api.list.call_count, 3)
+
+    async def test_label_filters_use_cached_label_directory(self):
+        service = self.use_fake_gmail({"a": metadata_message("a")})
+        users = service.users.return_value
+        params = {**READ_EMAILS_DEFAULTS, "source": "gmail"}
+
+        await main.read_emails(auth=True, **{**params, "Label": "downloaded"})
+        list_params = users.messages.return_value.list.call_args.kwargs
+        self.assertEqual(list_params["labelIds"], ["Label_D"])
+        self.assertEqual(list_params["q"], "")
+
+        await main.read_emails(auth=True, **{**params, "LabelId": "INBOX", "ExcludeLabelId": "Label_D"})
+        list_params = users.messages.return_value.list.call_args.kwargs
+        self.assertEqual(list_params["labelIds"], ["INBOX"])
+        self.assertEqual(list_params["q"], "-label:Downloaded")
+        self.assertEqual(users.labels.return_value.list.call_count, 1)
+
+        with self.assertRaises(HTTPException) as ctx:
+            await main.read_emails(auth=True, **{**params, "ExcludeLabelId": "Label_X"})
+        self.assertEqual(ctx.exception.status_code, 400)
+
+    async def test_label_directory_creates_missing_label_once(self):
+        service = self.use_fake_gmail({})
+        service.labels = [{"id": "INBOX", "name": "INBOX"}]
+        labels_api = service.users.return_value.labels.return_value
+        labels_api.create.side_effect = lambda userId, body: FakeRequest(lambda: {"id": "Label_N", **body})
+
+        with mock.patch.object(main, "LABEL_REFRESH_MIN_INTERVAL", -1):
+            first = await main.label_directory.get_or_create(service, "Downloaded")
+            second = await main.label_directory.get_or_create(service, "downloaded")
+
+        self.assertEqual(first["id"], "Label_N")
+        self.assertEqual(second["id"], "Label_N")
+        self.assertEqual(labels_api.create.call_count, 1)
+
+        # Creata da un altro client: il 409 porta a rileggere le label
+        service.labels.append({"id": "Label_O", "name": "Other"})
+
+        def conflict():
+            raise http_error(409)
+
+        labels_api.create.side_effect = lambda userId, body: FakeRequest(conflict)
+        with mock.patch.object(main, "LABEL_REFRESH_MIN_INTERVAL", 3600):
+            other = await main.label_directory.get_or_create(service, "Other")
+        self.assertEqual(other["id"], "Label_O")
+
+    async def test_download_attachments_fetches_parts_concurrently(self):
+        message = full_message("m")
+        message["payload"]["parts"] = [
+            {"partId": str(i), "filename": f"file{i}.txt", "body": {"attachmentId": f"att{i}", "size": 2}}
+            for i in range(4)
+        ]
+        service = self.use_fake_gmail({"m": message})
+        messages_api = service.users.return_value.messages.return_value
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def fetch(attachment_id):
+            with lock:
+                running.append(attachment_id)
+                peak.append(len(running))
+            main.time.sleep(0.05)
+            with lock:
+                running.remove(attachment_id)
+            return {"data": main.base64.urlsafe_b64encode(attachment_id.encode()).decode()}
+
+        messages_api.attachments.return_value.get.side_effect = (
+            lambda userId, messageId, id, **params: FakeRequest(lambda: fetch(id))
+        )
+
+        with mock.patch.object(main, "ATTACHMENT_FETCH_CONCURRENCY", 3):
+            result = await main.download_attachments("m", auth=True)
+
+        self.assertEqual([a["filename"] for a in result["attachments"]], [f"file{i}.txt" for i in range(4)])
+        with open(os.path.join(self.attachment_dir, "m", "file2.txt"), "rb") as f:
+            self.assertEqual(f.read(), b"att2")
+        self.assertEqual(max(peak), 3)
+        self.assertEqual(messages_api.batchModify.call_args.kwargs["body"], {"ids": ["m"], "addLabelIds": ["Label_D"]})
+
+    def test_base64url_decoder_handles_arbitrary_chunk_boundaries(self):
+        payload = os.urandom(1000)
+        body = json.dumps({"data": main.base64.urlsafe_b64encode(payload).decode().rstrip("=")}).encode()
+        for size in (1, 3, 7, 64, len(body)):
+            reader = main.JsonStringFieldReader("data")
+            decoder = main.Base64UrlDecoder()
+            decoded = b"".join(
+                decoder.feed(reader.feed(body[start:start + size])) for start in range(0, len(body), size)
+            )
+            self.assertTrue(reader.done)
+            self.assertEqual(decoded + decoder.finish(), payload)
+
+    async def test_download_attachment_streams_to_file_with_httpx_backend(self):
+        payload = os.urandom(200000)
+        body = json.dumps({"data": main.base64.urlsafe_b64encode(payload).decode()}).encode()
+
+        def handler(request):
+            self.assertEqual(request.url.params["fields"], "data")
+            return httpx.Response(200, stream=httpx.ByteStream(body))
+
+        client = main.GoogleAsyncClient()
+        client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        client._semaphore = asyncio.Semaphore(4)
+        credentials = mock.Mock(valid=True, token="token")
+        with mock.patch.object(main, "google_http", client), \
+                mock.patch.object(main, "GOOGLE_API_BACKEND", "httpx"), \
+                mock.patch.object(main.google_services, "current_credentials", return_value=credentials):
+            with self.store.new_blob() as blob:
+                await main.download_attachment(None, "m", "att", blob)
+        await client.aclose()
+
+        self.assertEqual(blob.size, len(payload))
+        with open(self.store.blob_path(blob.sha256), "rb") as f:
+            self.assertEqual(f.read(), payload)
+        self.assertEqual(main.hashlib.sha256(payload).hexdigest(), blob.sha256)
+        self.assertFalse([name for name in os.listdir(self.store.store_dir) if name.endswith(".part")])
+
+    async def test_streamed_attachment_does_not_hold_httpx_slot_while_client_reads(self):
+        self.use_fake_gmail({"m": full_message("m", attachment="report.pdf")})
+        payload = os.urandom(3 * main.ATTACHMENT_CHUNK_SIZE)
+        body = json.dumps({"data": main.base64.urlsafe_b64encode(payload).decode()}).encode()
+
+        client = main.GoogleAsyncClient()
+        client._client = httpx.AsyncClient(
+            transport=httpx.MockTransport(lambda request: httpx.Response(200, stream=httpx.ByteStream(body)))
+        )
+        client._semaphore = asyncio.Semaphore(2)
+        credentials = mock.Mock(valid=True, token="token")
+        with mock.patch.object(main, "google_http", client), \
+                mock.patch.object(main, "GOOGLE_API_BACKEND", "httpx"), \
+                mock.patch.object(main.google_services, "current_credentials", return_value=credentials):
+            responses = [
+                await main.get_attachment("m", "1", source="gmail", range_header=None, auth=True) for _ in range(3)
+            ]
+            # Tre risposte aperte e non ancora lette: nessuno slot resta occupato
+            self.assertEqual(client._semaphore._value, 2)
+            for response in responses:
+                iterator = response.body_iterator
+                self.assertEqual(b"".join([chunk async for chunk in iterator]), payload)
+        await client.aclose()
+
+    async def test_attachment_decoding_and_file_io_run_off_the_event_loop(self):
+        service = self.use_fake_gmail({})
+        payload = os.urandom(200000)
+        service.users.return_value.messages.return_value.attachments.return_value.get.side_effect = (
+            lambda userId, messageId, id, **params: FakeRequest(
+                lambda: {"data": main.base64.urlsafe_b64encode(payload).decode()}
+            )
+        )
+        loop_thread = threading.get_ident()
+        threads = set()
+        iter_file_range = main.iter_file_range
+
+        def record(func):
+            def wrapper(*args, **kwargs):
+                threads.add(threading.get_ident())
+                return func(*args, **kwargs)
+            return wrapper
+
+        with mock.patch.object(main.BlobWriter, "write", record(main.BlobWriter.write)):
+            with self.store.new_blob() as blob:
+                await main.download_attachment(service, "m", "att", blob)
+        self.assertNotIn(loop_thread, threads)
+
+        def recording_range(*args):
+            for chunk in iter_file_range(*args):
+                threads.add(threading.get_ident())
+                yield chunk
+
+        threads.clear()
+        with mock.patch.object(main.Base64UrlDecoder, "feed", record(main.Base64UrlDecoder.feed)), \
+                mock.patch.object(main, "iter_file_range", recording_range):
+            streamed = b"".join([chunk async for chunk in main.iter_attachment_data(service, "m", "att")])
+            stored = b"".join([chunk async for chunk in main.iter_blob(self.store.blob_path(blob.sha256), blob.size)])
+        self.assertEqual(streamed, payload)
+        self.assertEqual(stored, payload)
+        self.assertTrue(threads)
+        self.assertNotIn(loop_thread, threads)
+
+    async def test_download_attachments_deduplicates_content_and_keeps_same_names_apart(self):
+        def message_with(message_id, *files):
+            message = full_message(message_id)
+            message["payload"]["parts"] = [
+                {"partId": str(i), "filename": name, "body": {"attachmentId": f"{message_id}-{content}"}}
+                for i, (name, content) in enumerate(files)
+            ]
+            return message
+
+        service = self.use_fake_gmail({
+            "m1": message_with("m1", ("invoice.pdf", "same"), ("invoice.pdf", "other")),
+            "m2": message_with("m2", ("../invoice.pdf", "same")),
+        })
+        messages_api = service.users.return_value.messages.return_value
+        messages_api.attachments.return_value.get.side_effect = lambda userId, messageId, id, **params: FakeRequest(
+            lambda: {"data": main.base64.urlsafe_b64encode(id.split("-")[1].encode()).decode()}
+        )
+
+        first = await main.download_attachments("m1", auth=True)
+        second = await main.download_attachments("m2", auth=True)
+
+        paths = [a["file_path"] for a in first["attachments"] + second["attachments"]]
+        self.assertEqual(paths, [
+            os.path.join(self.attachment_dir, "m1", "invoice.pdf"),
+            os.path.join(self.attachment_dir, "m1", "invoice (1).pdf"),
+            os.path.join(self.attachment_dir, "m2", "invoice.pdf"),
+        ])
+        self.assertTrue(os.path.samefile(paths[0], paths[2]))
+        with open(paths[1], "rb") as f:
+            self.assertEqual(f.read(), b"other")
+        blobs = [
+            name for directory, _, names in os.walk(self.store.store_dir)
+            if directory != self.store.store_dir for name in names
+        ]
+        self.assertEqual(len(blobs), 2)
+
+    async def test_download_attachments_resumes_from_manifest(self):
+        message = full_message("m")
+        message["payload"]["parts"] = [
+            {"partId": str(i), "filename": f"file{i}.txt", "body": {"attachmentId": f"att{i}"}} for i in range(3)
+        ]
+        service = self.use_fake_gmail({"m": message})
+        messages_api = service.users.return_value.messages.return_value
+        fetched = []
+        failures = {"att2": 1}
+
+        def fetch(attachment_id):
+            fetched.append(attachment_id)
+            if failures.get(attachment_id):
+                failures[attachment_id] -= 1
+                raise http_error(503)
+            return {"data": main.base64.urlsafe_b64encode(attachment_id.encode()).decode()}
+
+        messages_api.attachments.return_value.get.side_effect = (
+            lambda userId, messageId, id, **params: FakeRequest(lambda: fetch(id))
+        )
+
+        with self.assertRaises(HTTPException):
+            await main.download_attachments("m", auth=True)
+        self.assertEqual(messages_api.batchModify.call_count, 0)
+
+        # Ripresa: si scarica solo la parte mancante
+        fetched.clear()
+        result = await main.download_attachments("m", auth=True)
+        self.assertEqual(fetched, ["att2"])
+        self.assertEqual(result["resumed"], 2)
+        self.assertEqual([a["filename"] for a in result["attachments"]], ["file0.txt", "file1.txt", "file2.txt"])
+        self.assertEqual(messages_api.batchModify.call_count, 1)
+
+        # Messaggio completo: nessun download, ma la label viene riassegnata se su Gmail e' stata tolta
+        get_calls = messages_api.get.call_count
+        again = await main.download_attachments("m", auth=True)
+        self.assertEqual(again["attachments"], result["attachments"])
+        self.assertEqual(messages_api.get.call_count, get_calls)
+        self.assertEqual(fetched, ["att2"])
+        self.assertEqual(messages_api.batchModify.call_count, 2)
+        self.assertEqual(messages_api.batchModify.call_args.kwargs["body"]["ids"], ["m"])
+
+    async def test_single_part_message_is_its_own_attachment(self):
+        message = full_message("p")
+        message["payload"].update({
+            "mimeType": "application/pdf", "filename": "scan.pdf", "body": {"attachmentId": "att-p", "size": 3}
+        })
+        del message["payload"]["parts"]
+        service = self.use_fake_gmail({"p": message})
+        messages_api = service.users.return_value.messages.return_value
+        messages_api.attachments.return_value.get.side_effect = lambda userId, messageId, id, **params: FakeRequest(
+            lambda: {"data": main.base64.urlsafe_b64encode(b"pdf").decode()}
+        )
+        with mock.patch.object(main.google_services, "credentials", return_value=mock.Mock()):
+            self.mirror.sync(service)
+        self.assertEqual(self.mirror.pending_attachment_downloads(10), ["p"])
+
+        listed = await main.list_attachments("p", auth=True)
+        self.assertEqual([(a["part_id"], a["filename"]) for a in listed["attachments"]], [("0", "scan.pdf")])
+
+        result = await main.download_attachments("p", auth=True)
+        self.assertEqual([a["filename"] for a in result["attachments"]], ["scan.pdf"])
+        self.assertEqual(messages_api.batchModify.call_args.kwargs["body"]["ids"], ["p"])
+        streamed = await main.get_attachment("p", "0", source="store", range_header=None, auth=True)
+        self.assertTrue(os.path.samefile(streamed.path, os.path.join(self.attachment_dir, "p", "scan.pdf")))
+
+    async def test_get_attachment_serves_store_with_ranges_and_streams_from_gmail(self):
+        message = full_message("m", attachment="report.pdf")
+        service = self.use_fake_gmail({"m": message})
+        messages_api = service.users.return_value.messages.return_value
+        messages_api.attachments.return_value.get.side_effect = lambda userId, messageId, id, **params: FakeRequest(
+            lambda: {"data": main.base64.urlsafe_b64encode(b"0123456789").decode()}
+        )
+
+        async def body(response):
+            return b"".join([chunk async for chunk in response.body_iterator])
+
+        streamed = await main.get_attachment("m", "1", source="auto", range_header=None, auth=True)
+        self.assertIsInstance(streamed, main.StreamingResponse)
+        self.assertEqual(await body(streamed), b"0123456789")
+        self.assertEqual(streamed.media_type, "application/pdf")
+
+        with self.assertRaises(HTTPException) as ctx:
+            await main.get_attachment("m", "1", source="store", range_header=None, auth=True)
+        self.assertEqual(ctx.exception.status_code, 404)
+
+        await main.download_attachments("m", auth=True)
+        full = await main.get_attachment("m", "1", source="auto", range_header=None, auth=True)
+        self.assertIsInstance(full, main.FileResponse)
+        self.assertTrue(os.path.samefile(full.path, os.path.join(self.attachment_dir, "m", "report.pdf")))
+        self.assertEqual(full.headers["accept-ranges"], "bytes")
+
+        partial = await main.get_attachment("m", "1", source="auto", range_header="bytes=2-4", auth=True)
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(partial.headers["content-range"], "bytes 2-4/10")
+        self.assertEqual(await body(partial), b"234")
+
+        suffix = await main.get_attachment("m", "1", source="store", range_header="bytes=-3", auth=True)
+        self.assertEqual(await body(suffix), b"789")
+
+        with self.assertRaises(HTTPException) as ctx:
+            await main.get_attachment("m", "1", source="store", range_header="bytes=10-", auth=True)
+        self.assertEqual(ctx.exception.status_code, 416)
+        self.assertEqual(ctx.exception.headers["Content-Range"], "bytes */10")
+
+        with self.assertRaises(HTTPException) as ctx:
+            await main.get_attachment("m", "9", source="gmail", range_header=None, auth=True)
+        self.assertEqual(ctx.exception.status_code, 404)
+
+    async def test_bulk_download_labels_all_messages_with_one_batch_modify(self):
+        service = self.use_fake_gmail({
+            "a": full_message("a", attachment="a.pdf"),
+            "b": full_message("b"),
+            "c": full_message("c", attachment="c.pdf"),
+            "d": http_error(404),
+        })
+        messages_api = service.users.return_value.messages.return_value
+        messages_api.attachments.return_value.get.side_effect = lambda userId, messageId, id, **params: FakeRequest(
+            lambda: {"data": main.base64.urlsafe_b64encode(messageId.encode()).decode()}
+        )
+        request = main.BulkDownloadRequest(message_ids=["a", "b", "c", "d", "a"])
+
+        result = await main.download_attachments_bulk(request, auth=True)
+
+        self.assertEqual([message["message_id"] for message in result["messages"]], ["a", "b", "c", "d"])
+        self.assertEqual(result["downloaded"], 2)
+        self.assertEqual(result["failed"], 1)
+        self.assertIn("error", result["messages"][3])
+        self.assertEqual(result["messages"][1]["attachments"], [])
+        self.assertFalse(result["messages"][1]["labeled"])
+        self.assertTrue(result["messages"][2]["labeled"])
+        self.assertEqual(messages_api.batchModify.call_count, 1)
+        self.assertEqual(messages_api.batchModify.call_args.kwargs["body"], {"ids": ["a", "c"], "addLabelIds": ["Label_D"]})
+        self.assertEqual(service.users.return_value.labels.return_value.list.call_count, 1)
+
+        # Con i filtri: solo email con allegati, gia' scaricate; si riassegna solo la label, con un batchModify
+        attachment_gets = messages_api.attachments.return_value.get.call_count
+        by_filter = await main.download_attachments_bulk(main.BulkDownloadRequest(max_messages=2), auth=True)
+        self.assertIn("has:attachment", messages_api.list.call_args.kwargs["q"])
+        self.assertEqual([message["message_id"] for message in by_filter["messages"]], ["a", "b"])
+        self.assertEqual(by_filter["messages"][0]["resumed"], 1)
+        self.assertEqual(messages_api.attachments.return_value.get.call_count, attachment_gets)
+        self.assertEqual(messages_api.batchModify.call_count, 2)
+        self.assertEqual(messages_api.batchModify.call_args.kwargs["body"]["ids"], ["a"])
+
+        # Una lista vuota non ricade sui filtri
+        list_calls = messages_api.list.call_count
+        empty = await main.download_attachments_bulk(main.BulkDownloadRequest(message_ids=[]), auth=True)
+        self.assertEqual(empty, {"messages": [], "downloaded": 0, "failed": 0})
+        self.assertEqual(messages_api.list.call_count, list_calls)
+        self.assertEqual(messages_api.batchModify.call_count, 2)
+
+    async def test_attachments_zip_streams_store_and_gmail_parts(self):
+        service = self.use_fake_gmail({
+            "a": full_message("a", attachment="a.pdf"),
+            "b": full_message("b", attachment="b.pdf"),
+            "c": http_error(404),
+        })
+        messages_api = service.users.return_value.messages.return_value
+        messages_api.attachments.return_value.get.side_effect = lambda userId, messageId, id, **params: FakeRequest(
+            lambda: {"data": main.base64.urlsafe_b64encode(messageId.encode() * 50000).decode()}
+        )
+        await main.download_attachments("a", auth=True)
+        messages_api.attachments.return_value.get.reset_mock()
+
+        chunks = [
+            chunk async for chunk in main.stream_attachments_zip(service, ["a", "b", "c"], main.zipfile.ZIP_DEFLATED)
+        ]
+
+        self.assertGreater(len([chunk for chunk in chunks if chunk]), 2)
+        archive = main.zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+        self.assertEqual(archive.namelist(), ["a/a.pdf", "b/b.pdf", "errors.txt"])
+        self.assertEqual(archive.read("b/b.pdf"), b"b" * 50000)
+        self.assertEqual(archive.read("a/a.pdf"), b"a" * 50000)
+        self.assertTrue(archive.read("errors.txt").startswith(b"c: "))
+        # "a" letto dallo store, "b" da Gmail senza essere salvato
+        self.assertEqual(messages_api.attachments.return_value.get.call_count, 1)
+        self.assertFalse(os.path.exists(os.path.join(self.attachment_dir, "b")))
+
+    async def test_attachments_zip_does_not_hold_httpx_slot_between_reads(self):
+        service = self.use_fake_gmail({"b": full_message("b", attachment="b.pdf")})
+        payload = os.urandom(3 * main.ATTACHMENT_CHUNK_SIZE)
+        body = json.dumps({"data": main.base64.urlsafe_b64encode(payload).decode()}).encode()
+
+        client = main.GoogleAsyncClient()
+        client._client = httpx.AsyncClient(
+            transport=httpx.MockTransport(lambda request: httpx.Response(200, stream=httpx.ByteStream(body)))
+        )
+        client._semaphore = asyncio.Semaphore(1)
+        credentials = mock.Mock(valid=True, token="token")
+        with mock.patch.object(main, "google_http", client), \
+                mock.patch.object(main, "GOOGLE_API_BACKEND", "httpx"), \
+                mock.patch.object(main.google_services, "current_credentials", return_value=credentials):
+            archive_stream = main.stream_attachments_zip(service, ["b"], main.zipfile.ZIP_STORED)
+            chunks = [await anext(archive_stream)]
+            # Archivio a meta' dell'allegato di Gmail: il client condiviso resta libero
+            self.assertEqual(client._semaphore._value, 1)
+            chunks.extend([chunk async for chunk in archive_stream])
+        await client.aclose()
+
+        archive = main.zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+        self.assertEqual(archive.read("b/b.pdf"), payload)
+
+    async def test_send_email_streams_mime_through_media_upload(self):
+        self.use_fake_gmail({})
+        payload = os.urandom(300001)
+        attachment_path = os.path.join(self.temp_dir, "report 1.bin")
+        with open(attachment_path, "wb") as f:
+            f.write(payload)
+        uploads = []
+
+        async def handler(request):
+            uploads.append((request, await request.aread()))
+            return httpx.Response(200, json={"id": "sent-1"})
+
+        client = main.GoogleAsyncClient()
+        client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        client._semaphore = asyncio.Semaphore(4)
+        credentials = mock.Mock(valid=True, token="token")
+        request = main.EmailRequest(
+            to="to@example.com", subject="Fattura", body="In allegato", attachment_paths=[attachment_path, "/missing"]
+        )
+        with mock.patch.object(main, "google_http", client), \
+                mock.patch.object(main, "TEMP_DIR", self.temp_dir), \
+                mock.patch.object(main.google_services, "current_credentials", return_value=credentials):
+            result = await main.write_and_send_email(request, auth=True)
+        await client.aclose()
+
+        self.assertEqual(result["message_id"], "sent-1")
+        self.assertEqual(result["details"]["attachments"], ["report 1.bin"])
+        upload, content = uploads[0]
+        self.assertEqual(upload.url.path, "/upload/gmail/v1/users/me/messages/send")
+        self.assertEqual(upload.url.params["uploadType"], "media")
+        self.assertEqual(upload.headers["Content-Type"], "message/rfc822")
+        self.assertEqual(int(upload.headers["Content-Length"]), len(content))
+
+        message = email.message_from_bytes(content)
+        self.assertEqual(message["to"], "to@example.com")
+        text, attachment = message.get_payload()
+        self.assertEqual(text.get_payload(decode=True), "In allegato".encode())
+        self.assertEqual(attachment.get_filename(), "report 1.bin")
+        self.assertEqual(attachment.get_payload(decode=True), payload)
+
+    async def test_large_send_resumes_upload_after_dropped_connection(self):
+        self.use_fake_gmail({})
+        payload = os.urandom(5000)
+        received = bytearray()
+        puts = []
+        failures = {"drop": 1}
+
+        async def handler(request):
+            if request.method == "POST":
+                self.assertEqual(request.url.params["uploadType"], "resumable")
+                self.assertEqual(request.headers["X-Upload-Content-Type"], "message/rfc822")
+                return httpx.Response(200, headers={"Location": "https://upload.example/session"})
+            content = await request.aread()
+            content_range = request.headers["Content-Range"]
+            puts.append(content_range)
+            total = int(content_range.rsplit("/", 1)[1])
+            if content_range.startswith("bytes */"):
+                return httpx.Response(308, headers={"Range": f"bytes=0-{len(received) - 1}"})
+            start = int(content_range.split(" ")[1].split("-")[0])
+            self.assertEqual(start, len(received))
+            if start > 0 and failures["drop"]:
+                # La connessione cade dopo che meta' del blocco e' arrivata
+                failures["drop"] -= 1
+                received.extend(content[:len(content) // 2])
+                raise httpx.ReadError("connection reset")
+            received.extend(content)
+            if len(received) == total:
+                return httpx.Response(200, json={"id": "sent-big"})
+            return httpx.Response(308, headers={"Range": f"bytes=0-{len(received) - 1}"})
+
+        client = main.GoogleAsyncClient()
+        client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        client._semaphore = asyncio.Semaphore(4)
+        credentials = mock.Mock(valid=True, token="token")
+        free_slots = []
+
+        def record_free_slots(delay):
+            free_slots.append(client._semaphore._value)
+
+        upload = mock.Mock(filename="big.bin", file=io.BytesIO(payload))
+        with mock.patch.object(main, "google_http", client), \
+                mock.patch.object(main, "TEMP_DIR", self.temp_dir), \
+                mock.patch.object(main, "RESUMABLE_UPLOAD_THRESHOLD", 1000), \
+                mock.patch.object(main, "RESUMABLE_UPLOAD_CHUNK_SIZE", 4096), \
+                mock.patch.object(main.asyncio, "sleep", mock.AsyncMock(side_effect=record_free_slots)), \
+                mock.patch.object(main.google_services, "current_credentials", return_value=credentials):
+            result = await main.write_and_send_email_with_uploads(
+                auth=True, to="to@example.com", subject="Big", body="Body", cc=None, bcc=None, files=[upload]
+            )
+        await client.aclose()
+
+        self.assertEqual(result["message_id"], "sent-big")
+        self.assertEqual(failures["drop"], 0)
+        # Nessuno slot del client condiviso occupato durante l'attesa prima del nuovo tentativo
+        self.assertEqual(free_slots, [4])
+        self.assertEqual(sum(1 for content_range in puts if content_range.startswith("bytes */")), 1)
+        _, attachment = email.message_from_bytes(bytes(received)).get_payload()
+        self.assertEqual(attachment.get_payload(decode=True), payload)
+
+    async def test_concurrent_identical_reads_share_upstream_calls(self):
+        service = self.use_fake_gmail({str(i): metadata_message(str(i)) for i in range(3)})
+        messages_api = service.users.return_value.messages.return_value
+        list_messages = service.list_messages
+
+        def slow_list(params):
+            main.time.sleep(0.05)
+            return list_messages(params)
+
+        service.list_messages = slow_list
+        params = {**READ_EMAILS_DEFAULTS, "Label": "INBOX", "source": "gmail"}
+
+        first, second = await asyncio.gather(
+            main.read_emails(auth=True, **params),
+            main.read_emails(auth=True, **params),
+        )
+
+        self.assertEqual(first["emails"], second["emails"])
+        self.assertEqual(messages_api.list.call_count, 1)
+        self.assertEqual(len(service.get_params), 3)
+
+    async def test_single_flight_leader_cancellation_does_not_cancel_followers(self):
+        flight = main.SingleFlight()
+        release = asyncio.Event()
+
+        async def fetch():
+            await release.wait()
+            return "ok"
+
+        leader = asyncio.ensure_future(flight.run("key", fetch))
+        follower = asyncio.ensure_future(flight.run("key", fetch))
+        await asyncio.sleep(0)
+        leader.cancel()
+        release.set()
+
+        self.assertEqual(await follower, "ok")
+        self.assertEqual(flight.stats(), {"in_flight": 0, "calls": 1, "shared": 1})
+
 
 if __name__ == "__main__":
     unittest.main()